@@ -9,9 +9,11 @@ class DialGroup(QtWidgets.QFrame, Ui_dial_group):
         self.setupUi(self)
 
         self.meaning_label.setText(name)
-        self.slider.setMinimum(minimum // divisor)
-        self.slider.setMaximum(maximum // divisor)
+        # Setting the range may move the slider, which calls `valueChanged` before there is a slot
         self.divisor = divisor
+        self.slot = None
+        self.slider.setMinimum(int(minimum // divisor))
+        self.slider.setMaximum(int(maximum // divisor))
         self.slot = slot
 
     @QtCore.pyqtSlot(int)
@@ -1,27 +1,36 @@
 import os
 from fractions import Fraction
+from typing import Optional
 
-import serial
 from PyQt5 import QtCore, QtWidgets
 
 from GUI.chart_selection_dialog.chart_selection import ChartSelectionDialog
 from GUI.etternuino_main.etternuino_gui import Ui_etternuino_window
 from GUI.visuterna_window.visuterna_window import VisuternaWindow
 from chart_player import ChartPlayer
+from clap_mapper import BaseClapMapper, SnapClapMapper
 from definitions import ARDUINO_MESSAGE_LENGTH, BYTE_FALSE, capture_exceptions
+from devices import open_device
+from pcm_cache import PcmCache
+from serial_protocol import LegacyProtocol, negotiate
 from simfile_parsing.basic_types import Time
 from simfile_parsing.simfile_parser import Simfile, SimfileParser
+from timeline_cache import TimelineCache
 
 
 class EtternuinoMain(QtWidgets.QMainWindow, Ui_etternuino_window):
-    def __init__(self):
+    def __init__(self, device: Optional[str] = None):
         super().__init__()
         self.setupUi(self)
 
         self.player: ChartPlayer = None
-        # self.arduino = None
-        self.arduino = serial.Serial('/dev/ttyUSB0')
+        # See `devices.open_device` for what `device` may name
+        self.arduino = open_device(device)
+        self.protocol = negotiate(self.arduino) if self.arduino else LegacyProtocol()
         self.threads = []
+        self.timeline_cache = TimelineCache()
+        self.pcm_cache = PcmCache()
+        self.clap_mapper: BaseClapMapper = None
         self.visuterna_window: VisuternaWindow = None
         self.chart_selection: ChartSelectionDialog = None
 
@@ -29,11 +38,12 @@ class EtternuinoMain(QtWidgets.QMainWindow, Ui_etternuino_window):
 
     @QtCore.pyqtSlot(int)
     def change_current_time(self, new_value):
-        self.player.mixer.current_frame = new_value
+        self.player.seek(new_value)
 
     @QtCore.pyqtSlot()
     def update_player(self):
         self.player.need_to_update_position = True
+        self.player.wakeup.set()
 
     @QtCore.pyqtSlot()
     @capture_exceptions
@@ -73,8 +83,12 @@ class EtternuinoMain(QtWidgets.QMainWindow, Ui_etternuino_window):
     @QtCore.pyqtSlot()
     @capture_exceptions
     def open_visuterna(self):
-        self.visuterna_window = VisuternaWindow(4, self.player)
+        self.visuterna_window = VisuternaWindow(self.player.chart.note_field.lanes, self.player)
         self.player.on_write.connect(self.visuterna_window.receive_event)
+        self.player.on_resync.connect(self.visuterna_window.receive_resync)
+        self.player.time_tick.connect(self.visuterna_window.receive_time)
+        self.visuterna_window.progress_slider.setMaximum(self.player.length_frames)
+        self.visuterna_window.time_changed.connect(self.change_current_time)
         self.player.on_end.connect(self.visuterna_window.close)
         self.visuterna_window.show()
 
@@ -90,7 +104,11 @@ class EtternuinoMain(QtWidgets.QMainWindow, Ui_etternuino_window):
             audio=parsed_simfile.music,
             sound_start_delta=Time(Fraction(0, 1)),
             arduino=self.arduino,
-            clap_mapper=None,
+            clap_mapper=self.clap_mapper,
+            timeline_cache=self.timeline_cache,
+            pcm_cache=self.pcm_cache,
+            protocol=self.protocol,
+            schedule_on_device=True,
         )
 
         player_thread = QtCore.QThread()
@@ -100,11 +118,18 @@ class EtternuinoMain(QtWidgets.QMainWindow, Ui_etternuino_window):
         self.player.on_start.connect(self.open_visuterna)
         self.player.play_signal.connect(self.player.play)
         self.player.on_end.connect(self.cleanup)
+        self.player.on_report.connect(self.show_report)
 
         self.threads.append(player_thread)
         self.player.play_signal.emit()
 
 
+    @QtCore.pyqtSlot(str)
+    def show_report(self, report: str):
+        """Lateness histogram and writer counters of a finished play, the summary stays in the status bar"""
+        print(report)
+        self.statusBar().showMessage(report.splitlines()[-1])
+
     @QtCore.pyqtSlot()
     def cleanup(self):
         if self.chart_selection:
@@ -113,7 +138,7 @@ class EtternuinoMain(QtWidgets.QMainWindow, Ui_etternuino_window):
         if self.player:
             self.player.cleanup()
         if self.arduino:
-            self.arduino.write(BYTE_FALSE * ARDUINO_MESSAGE_LENGTH)
+            self.arduino.write(self.protocol.encode(BYTE_FALSE * ARDUINO_MESSAGE_LENGTH))
 
         self.threads.clear()
 
@@ -131,4 +156,5 @@ class EtternuinoMain(QtWidgets.QMainWindow, Ui_etternuino_window):
 
     @QtCore.pyqtSlot(bool)
     def add_claps(self, new_state):
-        pass
+        # Claps are mixed in when a chart starts, so this applies from the next one on
+        self.clap_mapper = SnapClapMapper() if new_state else None
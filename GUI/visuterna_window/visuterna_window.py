@@ -3,9 +3,9 @@ from PyQt5 import QtCore, QtWidgets, QtGui
 
 from GUI.dial_group.dial_group import DialGroup
 from GUI.visuterna_window.visuterna_gui import Ui_visuterna_dialog
-from chart_player import NoteEvent
-from definitions import LANE_PINS, capture_exceptions
-from simfile_parsing.rows import Snap
+from event_scheduler import NoteEvent
+from definitions import capture_exceptions
+from simfile_parsing.snaps import SNAP_COLORS, snap_from_frame, snap_value
 
 
 class VisuternaWindow(QtWidgets.QDialog, Ui_visuterna_dialog):
@@ -17,6 +17,8 @@ class VisuternaWindow(QtWidgets.QDialog, Ui_visuterna_dialog):
 
         self.unpause_btn.hide()
         self.nps_window = 3.0
+        # Setting the dials below already calls their slots, which talk to the player
+        self.player = player
 
         self.lane_frames = []
         self.lane_nps_bars = []
@@ -46,12 +48,17 @@ class VisuternaWindow(QtWidgets.QDialog, Ui_visuterna_dialog):
         self.dial_group.addWidget(self.local_nps_dial_group)
         self.global_nps_dial_group = DialGroup("Global NPS max", 0, 60, 1, self.modify_global)
         self.dial_group.addWidget(self.global_nps_dial_group)
+        self.led_offset_dial_group = DialGroup("LED offset (ms)", -200, 200, 1, self.modify_led_offset)
+        self.dial_group.addWidget(self.led_offset_dial_group)
+        self.rate_dial_group = DialGroup("Rate (%)", 50, 200, 5, self.modify_rate)
+        self.dial_group.addWidget(self.rate_dial_group)
 
         self.local_nps_dial_group.slider.setValue(20000)
         self.global_nps_dial_group.slider.setValue(60000)
         self.nps_window_dial_group.slider.setValue(3000)
+        self.rate_dial_group.slider.setValue(round(player.rate * 20) if player else 20)
 
-        self.player = player
+        self.snap_colors = [QtGui.QColor(*snap_color) for snap_color in SNAP_COLORS.tolist()]
 
     def modify_local(self, new_max):
         for lane_nps_bar in self.lane_nps_bars:
@@ -63,24 +70,46 @@ class VisuternaWindow(QtWidgets.QDialog, Ui_visuterna_dialog):
     def modify_nps_window(self, new_window):
         self.nps_window = new_window
 
+    @capture_exceptions
+    def modify_led_offset(self, new_offset):
+        self.player and self.player.set_led_offset(new_offset / 1000)
+
+    @capture_exceptions
+    def modify_rate(self, new_rate):
+        self.player and self.player.set_rate(new_rate / 100)
+
     @QtCore.pyqtSlot(int)
     def rewind(self, new_time):
         self.time_changed.emit(new_time)
 
+    @QtCore.pyqtSlot(object)
+    def receive_time(self, new_time):
+        self.progress_slider.blockSignals(True)
+        self.progress_slider.setValue(int(new_time * self.player.mixer.sample_rate))
+        self.progress_slider.blockSignals(False)
+
+    @QtCore.pyqtSlot(object)
+    @capture_exceptions
+    def receive_resync(self, state: bytes):
+        snap_color = self.snap_colors[snap_from_frame(state)]
+        lane_pins = self.player.lane_pin_map(len(self.lane_frames))
+        for lane, lane_frame in enumerate(self.lane_frames):
+            if state[lane_pins[lane]] == 1:
+                pal = lane_frame.palette()
+                pal.setColor(lane_frame.backgroundRole(), snap_color)
+                lane_frame.setPalette(pal)
+            else:
+                lane_frame.setPalette(self.palette())
+
     @QtCore.pyqtSlot(object)
     @capture_exceptions
     def receive_event(self, event: NoteEvent):
-        snap = Snap.from_row(event.row)
-        snap_color = snap.color
-        for lane in range(len(LANE_PINS)):
+        snap_color = self.snap_colors[snap_value(event.row.pos.denominator)]
+        for lane, state in event.lane_states.items():
             lane_frame = self.lane_frames[lane]
-            if event.row.objects[lane] in ('0', 'M'):
-                continue
-            if event.row.objects[lane] in ('1', '2', '3', '4', '5'):
-                if event.state:
-                    pal = lane_frame.palette()
-                    pal.setColor(lane_frame.backgroundRole(),
-                                 QtGui.QColor(snap_color.r, snap_color.g, snap_color.b))
-                    lane_frame.setPalette(pal)
-                else:
-                    lane_frame.setPalette(self.palette())
+            if state:
+                pal = lane_frame.palette()
+                pal.setColor(lane_frame.backgroundRole(), snap_color)
+                lane_frame.setPalette(pal)
+            else:
+                lane_frame.setPalette(self.palette())
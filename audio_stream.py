@@ -0,0 +1,250 @@
+import subprocess
+import threading
+import time
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+import pydub
+import pydub.utils
+import soundfile as sf
+
+from resampler import resample_blocks
+from simfile_parsing.basic_types import Time
+
+CHANNELS = 2
+BLOCK_FRAMES = 4096
+RING_SECONDS = 2
+
+
+def to_stereo(data: np.ndarray) -> np.ndarray:
+    if data.shape[1] == CHANNELS:
+        return data
+    if data.shape[1] == 1:
+        return np.repeat(data, CHANNELS, axis=1)
+    return data[:, :CHANNELS]
+
+
+class RingBuffer(object):
+    """Bounded frame queue between one decoder thread and the audio callback.
+
+    Positions only ever grow, the slot of a frame is its position modulo `capacity`.
+    The lock is only held for the copies themselves.
+    """
+
+    def __init__(self, capacity: int, channels: int = CHANNELS):
+        self.data = np.zeros((capacity, channels), dtype=np.float32)
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.read_pos = 0
+        self.write_pos = 0
+        self.finished = False
+
+    @property
+    def available(self) -> int:
+        return self.write_pos - self.read_pos
+
+    @property
+    def exhausted(self) -> bool:
+        return self.finished and not self.available
+
+    def write(self, frames: np.ndarray) -> int:
+        """Copy as many of `frames` as there is room for, returns how many"""
+        with self.lock:
+            amount = min(self.capacity - self.available, frames.shape[0])
+            self._copy(self.write_pos, frames[:amount], into_ring=True)
+            self.write_pos += amount
+        return amount
+
+    def read_into(self, out: np.ndarray) -> int:
+        """Fill the start of `out` with whatever is buffered, returns how many frames"""
+        with self.lock:
+            amount = min(self.available, out.shape[0])
+            self._copy(self.read_pos, out[:amount], into_ring=False)
+            self.read_pos += amount
+        return amount
+
+    def clear(self):
+        with self.lock:
+            self.read_pos = self.write_pos
+            self.finished = False
+
+    def _copy(self, position: int, frames: np.ndarray, into_ring: bool):
+        start = position % self.capacity
+        head = min(frames.shape[0], self.capacity - start)
+        if into_ring:
+            self.data[start:start + head] = frames[:head]
+            self.data[:frames.shape[0] - head] = frames[head:]
+        else:
+            frames[:head] = self.data[start:start + head]
+            frames[head:] = self.data[:frames.shape[0] - head]
+
+
+def soundfile_blocks(path: str, start_frame: int) -> Iterator[np.ndarray]:
+    with sf.SoundFile(path) as source:
+        source.seek(start_frame)
+        while True:
+            data = source.read(BLOCK_FRAMES, dtype='float32', always_2d=True)
+            if not data.shape[0]:
+                return
+            yield to_stereo(data)
+
+
+def ffmpeg_blocks(path: str, start_frame: int, sample_rate: int) -> Iterator[np.ndarray]:
+    """Decode whatever ffmpeg can read, for the formats libsndfile can't"""
+    command = [
+        pydub.AudioSegment.converter, '-v', 'quiet',
+        '-ss', f'{start_frame / sample_rate:.6f}', '-i', path,
+        '-f', 'f32le', '-ac', str(CHANNELS), '-ar', str(sample_rate), '-'
+    ]
+    frame_bytes = 4 * CHANNELS
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stdin=subprocess.DEVNULL) as process:
+        try:
+            pending = b''
+            while True:
+                chunk = process.stdout.read(BLOCK_FRAMES * frame_bytes)
+                if not chunk:
+                    return
+                chunk = pending + chunk
+                usable = len(chunk) - len(chunk) % frame_bytes
+                pending = chunk[usable:]
+                yield np.frombuffer(chunk[:usable], dtype=np.float32).reshape(-1, CHANNELS)
+        finally:
+            process.kill()
+
+
+def probe(path: str) -> Tuple[int, bool]:
+    """Sample rate of `path` and whether libsndfile can decode it"""
+    try:
+        return sf.info(path).samplerate, True
+    except Exception:
+        return int(pydub.utils.mediainfo(path)['sample_rate']), False
+
+
+def rated_source_rate(source_rate: int, rate: float) -> int:
+    """Rate to resample from so audio plays `rate` times as fast, pitch goes along with it"""
+    return int(round(source_rate * rate))
+
+
+def file_blocks(path: str, start_frame: int, sample_rate: int, use_soundfile: bool) -> Iterator[np.ndarray]:
+    if use_soundfile:
+        return soundfile_blocks(path, start_frame)
+    return ffmpeg_blocks(path, start_frame, sample_rate)
+
+
+class ArraySource(object):
+    """Plays an already decoded (or memory-mapped) array, same interface as `StreamingDecoder`"""
+
+    def __init__(self, data: np.ndarray, sample_rate: int, sound_start: Time = 0):
+        self.data = data
+        self.sample_rate = sample_rate
+        self.start_frame = int(sample_rate * sound_start)
+        self.position = 0
+        self.seeking = False
+
+    @property
+    def exhausted(self) -> bool:
+        return self.start_frame + self.position >= self.data.shape[0]
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def seek(self, frame: int):
+        self.position = frame
+
+    def read_into(self, out: np.ndarray) -> int:
+        source_frame = self.start_frame + self.position
+        silence = min(max(-source_frame, 0), out.shape[0])
+        out[:silence] = 0
+        source_frame += silence
+        chunk = self.data[source_frame:source_frame + out.shape[0] - silence]
+        out[silence:silence + chunk.shape[0]] = chunk
+
+        amount = silence + chunk.shape[0]
+        self.position += amount
+        return amount
+
+
+class StreamingDecoder(threading.Thread):
+    """Decodes `path` into `ring` from a background thread, one block at a time.
+
+    Frame 0 of the stream is `sound_start` seconds into the file, a negative
+    `sound_start` plays silence first. `seek` restarts decoding anywhere.
+    Audio is resampled to `sample_rate` if given, it keeps its own rate otherwise,
+    and sped up `rate` times, its frames count in played time.
+    """
+
+    def __init__(self,
+                 path: str,
+                 sound_start: Time = 0,
+                 ring_seconds: float = RING_SECONDS,
+                 sample_rate: Optional[int] = None,
+                 rate: float = 1.):
+        super().__init__(daemon=True)
+        self.path = path
+        self.source_rate, self.use_soundfile = probe(path)
+        self.sample_rate = sample_rate or self.source_rate
+        self.rate = rate
+        self.start_frame = int(self.sample_rate * sound_start / rate)
+        self.ring = RingBuffer(int(self.sample_rate * ring_seconds))
+        self.position = 0
+        self.pending_seek: Optional[int] = None
+        self.stopped = False
+
+    @property
+    def seeking(self) -> bool:
+        return self.pending_seek is not None
+
+    @property
+    def exhausted(self) -> bool:
+        return self.ring.exhausted
+
+    def read_into(self, out: np.ndarray) -> int:
+        return self.ring.read_into(out)
+
+    def seek(self, frame: int):
+        self.pending_seek = frame
+
+    def stop(self):
+        self.stopped = True
+
+    def _interrupted(self) -> bool:
+        return self.stopped or self.pending_seek is not None
+
+    def _blocks(self, frame: int) -> Iterator[np.ndarray]:
+        target_frame = self.start_frame + frame
+        if target_frame < 0:
+            yield np.zeros((-target_frame, CHANNELS), dtype=np.float32)
+            target_frame = 0
+        rated_rate = rated_source_rate(self.source_rate, self.rate)
+        source_frame = target_frame * rated_rate // self.sample_rate
+        blocks = file_blocks(self.path, source_frame, self.source_rate, self.use_soundfile)
+        yield from resample_blocks(blocks, rated_rate, self.sample_rate)
+
+    def _push(self, block: np.ndarray):
+        while block.shape[0] and not self._interrupted():
+            written = self.ring.write(block)
+            block = block[written:]
+            if block.shape[0]:
+                time.sleep(BLOCK_FRAMES / self.sample_rate / 2)
+
+    def run(self):
+        while not self.stopped:
+            seek = self.pending_seek
+            if seek is not None:
+                # Cleared before the seek is marked done, the mixer stays silent in between
+                self.ring.clear()
+                self.position = seek
+                if self.pending_seek == seek:
+                    self.pending_seek = None
+
+            for block in self._blocks(self.position):
+                self._push(block)
+                if self._interrupted():
+                    break
+            else:
+                self.ring.finished = True
+                while not self._interrupted():
+                    time.sleep(0.01)
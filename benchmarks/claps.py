@@ -0,0 +1,58 @@
+"""Batch clap rendering against adding claps one row at a time.
+
+Usage: python -m benchmarks.claps [notes] [seconds]
+Spreads `notes` rows (3000 by default) over a `seconds` long chart, renders their
+claps with every built-in mapper, checks the result against plain per-row adds
+and exits with 1 on a mismatch.
+"""
+import sys
+
+import numpy as np
+
+from benchmarks.synthetic import measure
+from clap_mapper import LaneCountClapMapper, SnapClapMapper, render_claps
+from definitions import DEFAULT_SAMPLE_RATE
+from simfile_parsing.note_field import NoteField
+
+ROWS = ('1000', '0100', '0010', '0001', '2000', '0004', '1100', '0110', '1001', '1110', '1111')
+
+
+def synthetic_notes(count, seconds):
+    """`count` 16th rows of taps, jumps, hands and quads spread over `seconds`"""
+    rng = np.random.RandomState(0)
+    rows = rng.choice(ROWS, size=-(-count // 16) * 16)
+    measures = [''.join(rows[start:start + 16]) for start in range(0, rows.size, 16)]
+    notes = NoteField.from_measures(measures, 4).select(np.arange(count))
+    return notes.with_times(np.sort(rng.uniform(1, seconds, count)))
+
+
+def per_row(notes, clap_mapper):
+    start = int(round(notes.times[0] * DEFAULT_SAMPLE_RATE))
+    buffer = np.zeros((int(notes.times[-1] * DEFAULT_SAMPLE_RATE) - start + DEFAULT_SAMPLE_RATE, 1), dtype=np.float32)
+    for row in notes.rows():
+        clap = clap_mapper(row)
+        onset = int(round(row.time * DEFAULT_SAMPLE_RATE)) - start
+        buffer[onset:onset + clap.shape[0]] += clap
+    peak = np.abs(buffer).max()
+    return buffer / max(peak, 1)
+
+
+def main(count, seconds):
+    notes = synthetic_notes(count, seconds)
+    failed = False
+    for clap_mapper in (SnapClapMapper(), LaneCountClapMapper()):
+        batch = measure(lambda: render_claps(notes, clap_mapper, DEFAULT_SAMPLE_RATE))
+        rows = measure(lambda: per_row(notes, clap_mapper), repeat=1)
+
+        _, rendered = render_claps(notes, clap_mapper, DEFAULT_SAMPLE_RATE)
+        expected = per_row(notes, clap_mapper)[:rendered.shape[0]]
+        mismatch = np.abs(rendered - expected).max()
+        failed = failed or mismatch > 1e-5
+        print(f'{type(clap_mapper).__name__}: {len(notes)} claps over {seconds:.0f} s, '
+              f'batch {batch * 1000:.1f} ms, per row {rows * 1000:.1f} ms, mismatch {mismatch:.3g}')
+    return failed
+
+
+if __name__ == '__main__':
+    arguments = [float(argument) for argument in sys.argv[1:]]
+    sys.exit(1 if main(int(arguments[0]) if arguments else 3000, arguments[1] if len(arguments) > 1 else 180) else 0)
@@ -0,0 +1,128 @@
+"""When frames reach the LEDs, for every way of getting them there, against a simulated Arduino.
+
+Usage: python -m benchmarks.device_schedule [seconds] [--pty] [--baud BAUD]
+Plays the first `seconds` (default 10) of a generated chart to `SimulatedDevice`,
+which models the wire at the negotiated baud rate and the firmware's parse time:
+legacy frames written on time by the host, compact frames written on time by
+the host and frames fired by the device from its own clock. Reports how late
+every pin write got done against the schedule. The chart is seeded, so runs
+compare scheduler and protocol changes.
+"""
+import argparse
+import sys
+import tempfile
+import time
+
+import numpy as np
+import serial
+
+from benchmarks.synthetic import write_synthetic_simfile
+from device_scheduler import DeviceScheduler
+from event_scheduler import EventScheduler
+from serial_protocol import DEFAULT_BAUD_RATE, LegacyProtocol, negotiate, pin_masks
+from serial_writer import SerialWriter
+from simfile_parsing.simfile_parser import parse_simfile
+from simulated_device import FIRST_PIN, SimulatedDevice, SimulatedPort
+from timeline_cache import compile_timeline
+
+# Seconds between starting the clock and the first frame, and after the last one
+LEAD_IN = 0.5
+SETTLE = 0.2
+# The host wakes this much before a deadline and spins the rest, like `ChartPlayer`
+SPIN_DURATION = 0.002
+
+
+def synthetic_timeline(chart, protocol, seconds: float):
+    events = compile_timeline(chart, EventScheduler(frame_spacing=protocol.frame_duration)).events
+    events = events[events['time'] < seconds]
+    return events['time'] - events['time'][0] + LEAD_IN, events['frame']
+
+
+def final_state(frames: np.ndarray) -> np.ndarray:
+    """Level of every pin once all `frames` are written"""
+    pins = np.zeros(frames.shape[1], dtype=np.uint8)
+    states, changes = pin_masks(frames)
+    for state, change in zip(states.tolist(), changes.tolist()):
+        for pin in range(FIRST_PIN, frames.shape[1]):
+            if change >> pin & 1:
+                pins[pin] = state >> pin & 1
+    return pins
+
+
+def host_timed(port, protocol, clock, times, frames):
+    writer = SerialWriter(port, protocol, clock)
+    writer.start()
+    for deadline, frame, message in zip(times.tolist(), frames, protocol.encode_frames(frames)):
+        while clock() < deadline:
+            time.sleep(max(0., min(deadline - clock() - SPIN_DURATION, 0.01)))
+        writer.put(frame.tobytes(), deadline, message)
+    writer.flush()
+    writer.stop()
+    print(f'  host: {writer.report()}')
+
+
+def device_timed(port, protocol, clock, times, frames):
+    scheduler = DeviceScheduler(port, protocol, clock, lambda: True)
+    scheduler.load(times, frames)
+    scheduler.start()
+    while clock() < times[-1]:
+        time.sleep(0.01)
+    scheduler.stop()
+    scheduler.join()
+    print(f'  host: {scheduler.report()}')
+
+
+def connect(device: SimulatedDevice):
+    if device.port_name is None:
+        return SimulatedPort(device, timeout=1)
+    return serial.Serial(device.port_name, timeout=1)
+
+
+def run(name, play, chart, seconds: float, use_pty: bool, baud_rate: int, legacy: bool = False) -> bool:
+    device = SimulatedDevice(use_pty=use_pty)
+    device.start()
+    port = connect(device)
+    protocol = LegacyProtocol() if legacy else negotiate(port, baud_rate)
+    times, frames = synthetic_timeline(chart, protocol, seconds)
+
+    start = time.perf_counter()
+    clock = lambda: time.perf_counter() - start
+    print(f'{name}, protocol version {protocol.version} at {protocol.baud_rate} baud, {len(times)} frames:')
+    play(port, protocol, clock, times, frames)
+    time.sleep(SETTLE)
+    port.close()
+    device.close()
+    print(f'  device: {device.report()}')
+    print(device.lateness(times.tolist(), start).report())
+
+    if len(device.writes) != len(times):
+        print(f'MISMATCH: {len(device.writes)} frames reached the pins, {len(times)} were scheduled')
+        return False
+    expected = final_state(frames)
+    if not np.array_equal(device.pins[FIRST_PIN:len(expected)], expected[FIRST_PIN:]):
+        print(f'MISMATCH: pins ended at {device.pins[FIRST_PIN:len(expected)]}, expected {expected[FIRST_PIN:]}')
+        return False
+    return True
+
+
+def main(arguments) -> int:
+    parser = argparse.ArgumentParser(description='LED lateness against a simulated Arduino')
+    parser.add_argument('seconds', type=float, nargs='?', default=10., help='Seconds of the chart to play')
+    parser.add_argument('--pty', action='store_true', help='Talk to the device over a pseudo-terminal')
+    parser.add_argument('--baud', type=int, default=DEFAULT_BAUD_RATE, help='Baud rate to negotiate')
+    options = parser.parse_args(arguments)
+
+    with tempfile.TemporaryDirectory() as directory:
+        chart = parse_simfile(write_synthetic_simfile(directory, charts=((4, 'Challenge'),))).charts[0]
+    matched = [
+        run('Legacy frames written on time by the host', host_timed, chart, options.seconds, options.pty,
+            options.baud, legacy=True),
+        run('Compact frames written on time by the host', host_timed, chart, options.seconds, options.pty,
+            options.baud),
+        run('Frames fired by the device', device_timed, chart, options.seconds, options.pty, options.baud)
+    ]
+    return 0 if all(matched) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
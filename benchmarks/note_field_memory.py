@@ -0,0 +1,36 @@
+"""Memory held by a timed chart as row objects and as a columnar `NoteField`.
+
+Usage: python -m benchmarks.note_field_memory [simfile.sm ...]
+"""
+import os
+import sys
+import tempfile
+import tracemalloc
+
+from benchmarks.synthetic import write_synthetic_simfile
+from simfile_parsing.simfile_parser import parse_simfile
+
+
+def allocated(func):
+    tracemalloc.start()
+    result = func()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size
+
+
+def main(file_paths):
+    for file_path in file_paths:
+        for chart in parse_simfile(file_path).charts:
+            timed = chart.timed_note_field
+            _, rows_size = allocated(lambda: list(timed.rows()))
+            print(f'{os.path.basename(file_path)} {chart.diff_name}: {len(timed)} rows, '
+                  f'row objects {rows_size / 1024:.0f} KiB, columns {timed.nbytes / 1024:.0f} KiB')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(sys.argv[1:])
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            main([write_synthetic_simfile(directory, measures=400)])
@@ -0,0 +1,82 @@
+"""Equivalence check and throughput of the fast `#NOTES:` reader against the grammar.
+
+Usage: python -m benchmarks.notes_reader [simfile.sm ...]
+Every given simfile (and a set of generated edge cases) is parsed both ways
+and the resulting charts are compared row by row before timing anything.
+"""
+import os
+import sys
+import tempfile
+
+from benchmarks.synthetic import make_simfile_text, measure, write_synthetic_simfile
+from simfile_parsing.notes_reader import read_simfile_text, split_notes_sections
+from simfile_parsing.simfile_parser import parse_simfile
+
+HEADER = '#TITLE:Edge case;\n#MUSIC:benchmark.ogg;\n#BPMS:0.000=120.000;\n'
+EDGE_CASES = {
+    'crlf newlines': make_simfile_text(measures=8).replace('\n', '\r\n'),
+    'solo chart': make_simfile_text(charts=((6, 'Medium'),), measures=8),
+    'trailing comma': HEADER + '#NOTES:dance-single:a:Hard:5:0,0:\n1000\n0100\n0010\n0001\n,\n;',
+    'no step artist': HEADER + '#NOTES:\n dance-single:\n :\n Hard:\n 5:\n 0,0:\n1000\n,0100 0010\n;',
+    'split rows': HEADER + '#NOTES:dance-single:a:Hard:5:0,0:10\n00\n01 00\n0010\n0001\n;',
+    'comments': HEADER + '#NOTES:dance-single:a:Hard:5:0,0:// who\n1000 // cares\n0100\n;',
+    'bad object': HEADER + '#NOTES:dance-single:a:Hard:5:0,0:1000\n01X0\n;',
+    'bad row length': HEADER + '#NOTES:dance-single:a:Hard:5:0,0:1000\n010\n;',
+    'empty measure': HEADER + '#NOTES:dance-single:a:Hard:5:0,0:1000\n,,0100\n;',
+    'unknown type': HEADER + '#NOTES:pump-single:a:Hard:5:0,0:10000\n;',
+    'no radar values': HEADER + '#NOTES:dance-single:a:Hard:5::1000\n;',
+}
+
+
+def describe(simfile):
+    return [
+        (chart.step_artist, chart.diff_name, chart.diff_value,
+         [(row.pos, row.time, row.objects) for row in chart.timed_note_field])
+        for chart in simfile.charts
+    ]
+
+
+def parse_both_ways(file_path):
+    results = []
+    for fast_notes in (True, False):
+        try:
+            results.append(describe(parse_simfile(file_path, fast_notes)))
+        except Exception as E:
+            results.append(type(E))
+    return results
+
+
+def check_equivalence(name, file_path):
+    fast, grammar = parse_both_ways(file_path)
+    used_fast_path = split_notes_sections(read_simfile_text(file_path)) is not None
+    verdict = 'same' if fast == grammar else 'DIFFERENT'
+    print(f'{name:>20}: {verdict}, {"fast path" if used_fast_path else "grammar fallback"}')
+    return fast == grammar
+
+
+def main(file_paths, directory):
+    equivalent = True
+    for name, text in EDGE_CASES.items():
+        file_path = os.path.join(directory, 'edge_case.sm')
+        with open(file_path, 'w', encoding='utf-8', newline='') as simfile:
+            simfile.write(text)
+        equivalent &= check_equivalence(name, file_path)
+    for file_path in file_paths:
+        equivalent &= check_equivalence(os.path.basename(file_path), file_path)
+
+    for file_path in file_paths:
+        rows = sum(len(chart.note_field) for chart in parse_simfile(file_path).charts)
+        fast = measure(lambda: parse_simfile(file_path), repeat=3)
+        grammar = measure(lambda: parse_simfile(file_path, fast_notes=False), repeat=3)
+        print(f'{os.path.basename(file_path)}: {rows} rows, '
+              f'fast {rows / fast:,.0f} rows/s ({fast * 1000:.1f} ms), '
+              f'grammar {rows / grammar:,.0f} rows/s ({grammar * 1000:.1f} ms)')
+
+    return equivalent
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as directory:
+        open(os.path.join(directory, 'benchmark.ogg'), mode='wb').close()
+        paths = sys.argv[1:] or [write_synthetic_simfile(directory, measures=400)]
+        sys.exit(0 if main(paths, directory) else 1)
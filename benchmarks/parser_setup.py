@@ -0,0 +1,55 @@
+"""Per-file parsing cost with and without the shared SM parser.
+
+Usage: python -m benchmarks.parser_setup [simfile.sm ...]
+Without arguments a synthetic simfile is generated in a temporary directory.
+"""
+import os
+import sys
+import tempfile
+
+import lark
+
+from benchmarks.synthetic import measure, write_synthetic_simfile
+from definitions import GRAMMAR_PATH
+from simfile_parsing import simfile_parser
+from simfile_parsing.simfile_parser import ChartTransformer, parse_simfile
+
+
+def build_uncached_parser():
+    return lark.Lark.open(GRAMMAR_PATH, parser='lalr', transformer=ChartTransformer(), start='simfile')
+
+
+def build_disk_cached_parser():
+    simfile_parser._build_sm_parser.cache_clear()
+    return simfile_parser.get_sm_parser()
+
+
+def parse_with_fresh_parser(file_path):
+    original = simfile_parser.get_sm_parser
+    simfile_parser.get_sm_parser = build_uncached_parser
+    try:
+        return parse_simfile(file_path)
+    finally:
+        simfile_parser.get_sm_parser = original
+
+
+def main(file_paths):
+    simfile_parser.get_sm_parser()
+
+    print(f'grammar build, no cache:     {measure(build_uncached_parser) * 1000:8.2f} ms')
+    print(f'grammar load from disk:      {measure(build_disk_cached_parser) * 1000:8.2f} ms')
+    print(f'grammar from process cache:  {measure(simfile_parser.get_sm_parser) * 1000:8.4f} ms')
+
+    for file_path in file_paths:
+        before = measure(lambda: parse_with_fresh_parser(file_path))
+        after = measure(lambda: parse_simfile(file_path))
+        print(f'{os.path.basename(file_path)}: '
+              f'before {before * 1000:.2f} ms/file, after {after * 1000:.2f} ms/file')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(sys.argv[1:])
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            main([write_synthetic_simfile(directory, measures=20)])
@@ -0,0 +1,53 @@
+"""Throughput of the streaming `Resampler` on a 10 minute stereo song.
+
+Usage: python -m benchmarks.resampling [minutes]
+Converts a 1 kHz tone from common music sample rates to DEFAULT_SAMPLE_RATE in
+decoder sized blocks, checks block-wise output against one-shot output and the
+ideal tone, and exits with 1 if either is off.
+"""
+import sys
+
+import numpy as np
+
+from audio_stream import BLOCK_FRAMES
+from benchmarks.synthetic import measure
+from definitions import DEFAULT_SAMPLE_RATE
+from resampler import resample_blocks
+
+SOURCE_RATES = (48000, 32000, 22050, 96000)
+TONE = 1000.0
+MAX_ERROR = 1e-2
+
+
+def tone(seconds, sample_rate) -> np.ndarray:
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    return np.stack([np.sin(2 * np.pi * TONE * t), np.cos(2 * np.pi * TONE * t)], axis=1).astype(np.float32)
+
+
+def resample(data, source_rate, block_frames=BLOCK_FRAMES) -> np.ndarray:
+    blocks = (data[start:start + block_frames] for start in range(0, data.shape[0], block_frames))
+    return np.concatenate(list(resample_blocks(blocks, source_rate, DEFAULT_SAMPLE_RATE)))
+
+
+def main(minutes):
+    failed = False
+    for source_rate in SOURCE_RATES:
+        data = tone(minutes * 60, source_rate)
+        seconds = measure(lambda: resample(data, source_rate), repeat=1)
+
+        check = data[:source_rate * 2]
+        blockwise = resample(check, source_rate, block_frames=1000)
+        one_shot = resample(check, source_rate, block_frames=check.shape[0])
+        ideal = tone(2, DEFAULT_SAMPLE_RATE)[:one_shot.shape[0]]
+        mismatch = np.abs(blockwise - one_shot).max()
+        error = np.abs(one_shot - ideal)[100:-100].max()
+        failed = failed or mismatch > 0 or error > MAX_ERROR
+
+        print(f'{source_rate} -> {DEFAULT_SAMPLE_RATE} Hz: {minutes} min in {seconds:.2f} s '
+              f'({minutes * 60 / seconds:.0f}x realtime), '
+              f'block mismatch {mismatch:.3g}, tone error {error:.3g}')
+    return failed
+
+
+if __name__ == '__main__':
+    sys.exit(1 if main(float(sys.argv[1]) if len(sys.argv) > 1 else 10) else 0)
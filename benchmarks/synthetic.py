@@ -0,0 +1,74 @@
+import os
+import random
+import time
+
+SNAPS = (4, 8, 12, 16, 24, 32, 48, 64, 192)
+CHART_TYPES = {
+    4: 'dance-single',
+    6: 'dance-solo',
+    8: 'dance-double'
+}
+
+
+def make_chart_text(lanes=4, measures=200, diff_name='Challenge', seed=0) -> str:
+    rng = random.Random(seed)
+    result = [
+        '#NOTES:',
+        f'     {CHART_TYPES[lanes]}:',
+        '     Benchmark:',
+        f'     {diff_name}:',
+        '     10:',
+        '     0.5,0.5,0.5,0.5,0.5:'
+    ]
+    for measure in range(measures):
+        for _ in range(rng.choice(SNAPS)):
+            result.append(''.join(rng.choice('00000000001112234M') for _ in range(lanes)))
+        result.append(',  // measure ' + str(measure + 1) if measure + 1 < measures else ';')
+    return '\n'.join(result)
+
+
+def make_simfile_text(charts=((4, 'Challenge'), (4, 'Hard'), (8, 'Edit')),
+                      measures=200,
+                      bpm_changes=3,
+                      seed=0) -> str:
+    rng = random.Random(seed)
+    bpms = ','.join(
+        f'{beat * 4 * measures // (bpm_changes + 1)}.000={rng.uniform(80, 240):.3f}'
+        for beat in range(bpm_changes + 1)
+    )
+    stops = ','.join(
+        f'{rng.randrange(4 * measures)}.000={rng.uniform(0.1, 1):.3f}'
+        for _ in range(bpm_changes)
+    )
+    result = [
+        '#TITLE:Benchmark;',
+        '#ARTIST:Etternuino;',
+        '#MUSIC:benchmark.ogg;',
+        '#OFFSET:-0.050;',
+        f'#BPMS:{bpms};',
+        f'#STOPS:{stops};',
+        '// charts follow'
+    ]
+    for index, (lanes, diff_name) in enumerate(charts):
+        result.append(make_chart_text(lanes, measures, diff_name, seed + index))
+    return '\n'.join(result) + '\n'
+
+
+def write_synthetic_simfile(directory: str, name='benchmark', **kwargs) -> str:
+    song_dir = os.path.join(directory, name)
+    os.makedirs(song_dir, exist_ok=True)
+    file_path = os.path.join(song_dir, f'{name}.sm')
+    with open(file_path, 'w', encoding='utf-8') as simfile:
+        simfile.write(make_simfile_text(**kwargs))
+    open(os.path.join(song_dir, 'benchmark.ogg'), mode='wb').close()
+    return file_path
+
+
+def measure(func, repeat=5):
+    """Best wall time of `repeat` calls of `func`, in seconds"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
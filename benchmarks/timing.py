@@ -0,0 +1,31 @@
+"""Exact Fraction timing against the vectorized `TimingMap`.
+
+Usage: python -m benchmarks.timing [simfile.sm ...]
+Without arguments a chart with hundreds of BPM changes and stops is generated.
+"""
+import os
+import sys
+import tempfile
+
+from benchmarks.synthetic import measure, write_synthetic_simfile
+from simfile_parsing.simfile_parser import parse_simfile
+
+
+def main(file_paths):
+    for file_path in file_paths:
+        simfile = parse_simfile(file_path)
+        for chart in simfile.charts:
+            exact = measure(lambda: chart.time(exact=True), repeat=3)
+            vectorized = measure(lambda: chart.time(), repeat=3)
+            print(f'{os.path.basename(file_path)} {chart.diff_name}: '
+                  f'{len(chart.note_field)} rows, {len(simfile.bpm_segments)} BPMs, {len(simfile.stop_segments)} stops, '
+                  f'exact {exact * 1000:.1f} ms, vectorized {vectorized * 1000:.1f} ms, '
+                  f'max deviation {chart.timing_deviation():.3g} s')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(sys.argv[1:])
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            main([write_synthetic_simfile(directory, measures=400, bpm_changes=400)])
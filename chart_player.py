@@ -1,126 +1,60 @@
-import io
+import threading
+import time
 from fractions import Fraction
-from operator import itemgetter
-from typing import Optional, Sequence
+from typing import Dict, Optional, Tuple, Union
 
-import pydub
+import numpy as np
 import serial
 import sounddevice as sd
 from PyQt5 import QtCore
-from attr import attrib, attrs
 
-from clap_mapper import BaseClapMapper
-from definitions import BYTE_FALSE, BYTE_TRUE, DEFAULT_SAMPLE_RATE, LANE_PINS, \
-    capture_exceptions, in_reduce, make_blank_message
-from mixer import Mixer
+from audio_stream import CHANNELS, ArraySource, StreamingDecoder
+from clap_mapper import BaseClapMapper, render_claps
+from definitions import DEFAULT_SAMPLE_RATE, DISPLAY_REFRESH_RATE, capture_exceptions, snap_rate
+from device_scheduler import DeviceScheduler
+from event_scheduler import EventScheduler
+from mixer import Mixer, SourceVoice, TrackVoice
+from pcm_cache import PcmCache
+from serial_protocol import CompactProtocol, LegacyProtocol, cut_off_pins
+from serial_writer import SerialWriter
 from simfile_parsing.basic_types import Time
-from simfile_parsing.rows import GlobalScheduledRow, Snap
+from simfile_parsing.complex_types import AssetReference
 from simfile_parsing.simfile_parser import AugmentedChart
+from sync_recorder import SyncRecorder
+from timeline_cache import CompiledTimeline, TimelineCache, compile_timeline
 
-
-@attrs
-class NoteEvent:
-    time: Time = attrib()
-    arduino_message: bytes = attrib()
-    row: GlobalScheduledRow = attrib()
-    state: bool = attrib()
-
-
-class EventScheduler:
-    def __init__(self):
-        self.microblink_duration = Fraction('0.01')
-        self.blink_duration = Fraction('0.12')
-
-    def schedule_events(self, notes: Sequence[GlobalScheduledRow]):
-        snap_sequence = self.obtain_snap_changes(notes)
-        lane_changes = self.obtain_lane_changes(notes)
-        ordered_events = self.compose_events(lane_changes, snap_sequence)
-        result = self.merge_events_into_messages(ordered_events)
-
-        return result
-
-    @staticmethod
-    def obtain_snap_changes(notes):
-        snap_sequence = []
-        for note in notes:
-            if in_reduce(all, note.objects, ('0', '3', '5', 'M')):
-                continue
-            snap_sequence.append((note.time,
-                                  Snap.from_row(note),
-                                  note))
-        return snap_sequence
-
-    def obtain_lane_changes(self, notes):
-        lane_changes = [[] for _ in range(len(LANE_PINS))]
-        for lane in range(len(LANE_PINS)):
-            active_list = lane_changes[lane]
-
-            for note in notes:
-                if note.objects[lane] in ('0', 'M'):
-                    continue
-                if note.objects[lane] in ('1',):
-                    if active_list and active_list[-1] > note.time:
-                        active_list[-1] = note.time - self.microblink_duration
-                    active_list.append(note.time)
-                    active_list.append(note.time + self.blink_duration)
-                if note.objects[lane] in ('2', '3', '4', '5'):
-                    if active_list and active_list[-1] > note.time:
-                        active_list[-1] = note.time - self.microblink_duration
-                    active_list.append(note.time)
-        return lane_changes
-
-    @staticmethod
-    def compose_events(lane_changes, snap_sequence):
-        ordered_events = []
-        for lane in range(len(LANE_PINS)):
-            active_list = lane_changes[lane]
-
-            snap_index = 0
-            for status, time in enumerate(active_list, start=1):
-                status %= 2
-                if status:
-                    while time > snap_sequence[snap_index][0]:
-                        if snap_index < len(snap_sequence):
-                            snap_index += 1
-                        else:
-                            break
-                    while time < snap_sequence[snap_index][0]:
-                        if snap_index:
-                            snap_index -= 1
-                        else:
-                            break
-                ordered_events.append((time, snap_sequence[snap_index], lane, status))
-        ordered_events.sort(key=itemgetter(0))
-
-        return ordered_events
-
-    @staticmethod
-    def merge_events_into_messages(ordered_events):
-        result = []
-        blank_message = make_blank_message()
-        for time, snap, lane, status in ordered_events:
-            message = blank_message.copy()
-            message[LANE_PINS[lane]] = status and BYTE_TRUE or BYTE_FALSE
-            for pin in snap[1].arduino_pins:
-                message[pin] = BYTE_TRUE
-            result.append(NoteEvent(time, b''.join(message), snap[2], bool(status)))
-        return result
+TICK_INTERVAL = 1 / DISPLAY_REFRESH_RATE
+# Sleeps end this early and the rest is spun, OS timers overshoot by about a millisecond
+SPIN_DURATION = 0.002
+# Seconds the last frames get to go out after the chart ends, a stalled port won't hold the player forever
+FLUSH_TIMEOUT = 1.
 
 
 class ChartPlayer(QtCore.QObject, EventScheduler):
     on_start = QtCore.pyqtSignal()
     on_end = QtCore.pyqtSignal()
     on_write = QtCore.pyqtSignal(object)
+    on_resync = QtCore.pyqtSignal(object)
+    # Sync and writer statistics of a finished play, see `report`
+    on_report = QtCore.pyqtSignal(str)
     time_tick = QtCore.pyqtSignal(object)
     play_signal = QtCore.pyqtSignal()
 
     @capture_exceptions
     def __init__(self,
                  chart: AugmentedChart,
-                 audio: io.BufferedReader,
+                 audio: AssetReference,
                  sound_start_delta: Time = 0,
                  arduino: Optional[serial.Serial] = None,
-                 clap_mapper: Optional[BaseClapMapper] = None):
+                 clap_mapper: Optional[BaseClapMapper] = None,
+                 lane_pins: Optional[Dict[int, int]] = None,
+                 timeline_cache: Optional[TimelineCache] = None,
+                 pcm_cache: Optional[PcmCache] = None,
+                 led_offset: float = 0.,
+                 rate: float = 1.,
+                 protocol: Optional[Union[LegacyProtocol, CompactProtocol]] = None,
+                 late_policy: str = 'send',
+                 schedule_on_device: bool = False):
         super().__init__()
 
         self.chart = chart
@@ -128,113 +62,312 @@ class ChartPlayer(QtCore.QObject, EventScheduler):
         self.sound_start_delta = sound_start_delta
         self.arduino = arduino
         self.arduino_muted = False
+        # What the firmware agreed to in `serial_protocol.negotiate`
+        self.protocol = protocol or LegacyProtocol()
+        self.frame_spacing = self.protocol.frame_duration
+        # What the writer does with frames that are late anyway, see `serial_writer.LATE_POLICIES`
+        self.late_policy = late_policy
+        self.writer: Optional[SerialWriter] = None
+        # Firmware that fires frames from its own clock gets the timeline uploaded ahead instead
+        self.schedule_on_device = schedule_on_device and self.protocol.schedules
+        self.device: Optional[DeviceScheduler] = None
         self.clap_mapper = clap_mapper
-
+        self.lane_pins = lane_pins
+        self.timeline_cache = timeline_cache
+        self.pcm_cache = pcm_cache
+        # Seconds the LEDs light up after a frame is written, frames go out this much earlier
+        self.led_offset = led_offset
+        self.recorder = SyncRecorder()
+        # Music plays `rate` times as fast, event times are divided by it
+        self.rate = snap_rate(rate)
+        # Cached music and claps of every rate played so far, switching back to one of them is instant
+        self.rate_pcm: Dict[float, np.ndarray] = {}
+        self.rate_workers: Dict[float, threading.Thread] = {}
+        self.clap_tracks: Dict[float, Tuple[int, np.ndarray]] = {}
+
+        self.timeline: Optional[CompiledTimeline] = None
+        self.event_times: Optional[np.ndarray] = None
+        # The timeline's frames encoded once, in `protocol`
+        self.messages = []
+        # Set when `protocol` can't carry every pin of the timeline, leads the report
+        self.pin_warning: Optional[str] = None
         self.mixer = None
+        self.audio_source = None
         self.music_stream = None
 
         self.need_to_die = False
         self.need_to_update_position = False
+        self.seek_frame: Optional[int] = None
+        self.wakeup = threading.Event()
+        self.last_tick = float('-inf')
 
     @QtCore.pyqtSlot()
     def pause(self):
-        self.mixer.paused = True
+        self.mixer.pause()
+        self.wakeup.set()
 
     @QtCore.pyqtSlot()
     def unpause(self):
-        self.mixer.paused = False
+        self.mixer.resume()
+        self.wakeup.set()
 
     @QtCore.pyqtSlot()
     def mute_arduino(self):
         self.arduino_muted = True
+        self.device and self.device.mute(True)
 
     @QtCore.pyqtSlot()
     def unmute_arduino(self):
         self.arduino_muted = False
+        self.device and self.device.mute(False)
 
     @QtCore.pyqtSlot()
     def mute_music(self):
-        self.mixer.muted = True
+        self.mixer.mute('music')
 
     @QtCore.pyqtSlot()
     def unmute_music(self):
-        self.mixer.muted = False
+        self.mixer.unmute('music')
+
+    @QtCore.pyqtSlot(float)
+    def set_led_offset(self, led_offset: float):
+        self.led_offset = led_offset
+        if self.device:
+            # Frames already on the device carry the old offset
+            self.need_to_update_position = True
+            self.wakeup.set()
+
+    @QtCore.pyqtSlot(float)
+    def set_rate(self, rate: float):
+        """Play `rate` times as fast from where the music is now"""
+        rate = snap_rate(rate)
+        if rate == self.rate:
+            return
+        if self.mixer is None:
+            self.rate = rate
+            return
+
+        frame = int(self.mixer.clock.frame * self.rate / rate)
+        source = self.source_for(rate)
+        source.start()
+        voices = {'music': SourceVoice(source)}
+        if self.clap_mapper:
+            voices['claps'] = TrackVoice()
+            start_frame, track = self.clap_track(rate)
+            voices['claps'].add(track, start_frame)
+
+        self.mixer.swap_voices(voices, frame)
+        self.audio_source = source
+        self.rate = rate
+        self.event_times = self.scaled_times(rate)
+        self.seek_frame = frame
+        self.need_to_update_position = True
+        self.wakeup.set()
+
+    @QtCore.pyqtSlot(int)
+    def seek(self, frame: int):
+        """Jump the music to `frame` of the song at 1.0x, `play` picks the events up from there"""
+        frame = int(frame / self.rate)
+        self.mixer.seek(frame)
+        self.seek_frame = frame
+        self.need_to_update_position = True
+        self.wakeup.set()
+
+    @property
+    def length_frames(self) -> int:
+        if self.timeline is None or not len(self.timeline.events):
+            return 0
+        return int(self.timeline.events['time'][-1] * self.mixer.sample_rate)
 
     @QtCore.pyqtSlot()
     def die(self):
         self.need_to_die = True
+        self.wakeup.set()
 
     def wait_till(self, end_time: Time) -> None:
-        while self.mixer.current_time < end_time:
-            self.time_tick.emit(self.mixer.current_time)
-            if self.need_to_update_position or self.need_to_die:
-                break
-            sd.sleep(1)
+        """Sleep until the audio clock reaches `end_time`, or a seek or `die` interrupts"""
+        end_time = float(end_time)
+        while True:
+            self.wakeup.clear()
+            now = self.mixer.clock.seconds
+            self.tick(now)
+            remaining = end_time - now
+            if remaining <= 0 or self.need_to_update_position or self.need_to_die:
+                return
+            if self.mixer.paused:
+                self.wakeup.wait(TICK_INTERVAL)
+            elif remaining > SPIN_DURATION:
+                self.wakeup.wait(min(remaining - SPIN_DURATION, TICK_INTERVAL))
+
+    def tick(self, now: float):
+        counter = time.perf_counter()
+        if counter - self.last_tick >= TICK_INTERVAL:
+            self.last_tick = counter
+            # Listeners get the position in the song, whatever the rate
+            self.time_tick.emit(Time(Fraction(now * self.rate)))
+
+    def source_for(self, rate: float):
+        """Music sped up `rate` times, resampled to the rate the output stream is opened at"""
+        path = self.audio.full_path
+        pcm = self.rate_pcm.get(rate)
+        if pcm is None and self.pcm_cache:
+            pcm = self.pcm_cache.load(self.pcm_cache.key(path, DEFAULT_SAMPLE_RATE, rate))
+        if pcm is not None:
+            self.rate_pcm[rate] = pcm
+            return ArraySource(pcm, DEFAULT_SAMPLE_RATE, self.sound_start_delta / rate)
+
+        # Play from the decoder right away, the next switch to this rate uses the cached copy.
+        # Without a cache the decoder streams every time, a whole song in memory is what it avoids
+        if self.pcm_cache and rate not in self.rate_workers:
+            self.rate_workers[rate] = threading.Thread(target=self.decode_rate, args=(rate,), daemon=True)
+            self.rate_workers[rate].start()
+        return StreamingDecoder(path, self.sound_start_delta, sample_rate=DEFAULT_SAMPLE_RATE, rate=rate)
+
+    def decode_rate(self, rate: float):
+        pcm = self.pcm_cache.load(self.pcm_cache.decode(self.audio.full_path, DEFAULT_SAMPLE_RATE, rate=rate))
+        if pcm is not None:
+            self.rate_pcm[rate] = pcm
+
+    def scaled_times(self, rate: float) -> np.ndarray:
+        times = self.timeline.events['time']
+        return times if rate == 1 else times / rate
 
     def load_audio(self):
-        pydub.AudioSegment.from_file(self.audio).export('temp.wav', format='wav')
-        self.mixer = Mixer.from_file('temp.wav', self.sound_start_delta)
-        self.music_stream = sd.OutputStream(channels=2,
+        self.audio_source = self.source_for(self.rate)
+        self.audio_source.start()
+        self.mixer = Mixer.from_stream(self.audio_source)
+        self.music_stream = sd.OutputStream(channels=CHANNELS,
                                             samplerate=DEFAULT_SAMPLE_RATE,
                                             dtype='float32',
                                             callback=self.mixer)
+        self.mixer.clock.fallback_latency = self.music_stream.latency
 
-    def chart_to_timed_rows(self, chart):
-        notes = sorted(chart.note_field)
-        notes = (
-            row
-            for row in notes
-            if not in_reduce(all, row.objects, ('0', 'M'))
-        )
-        notes = [
-            GlobalScheduledRow.from_source(row, self.sound_start_delta)
-            for row in notes
-        ]
-
-        return notes
+    def compile_timeline(self) -> CompiledTimeline:
+        return compile_timeline(self.chart, self, self.sound_start_delta, self.timeline_cache)
 
     @QtCore.pyqtSlot()
     @capture_exceptions
     def play(self):
-        notes = self.chart_to_timed_rows(self.chart)
-        sequence = self.schedule_events(notes)
+        self.timeline = timeline = self.compile_timeline()
+        self.event_times = self.scaled_times(self.rate)
+        notes, sequence = timeline.notes, timeline.events
+        self.pin_warning = cut_off_pins(self.protocol, sequence['frame'].shape[1])
+        checkpoints = self.state_checkpoints(sequence, notes.lanes)
 
         self.load_audio()
-        self.inject_claps(notes)
+        self.inject_claps()
 
         try:
             first_note = notes[0]
         except IndexError:
             return
 
+        self.device = None
+        if self.schedule_on_device:
+            # Uploading starts before the music does, the first frames may be due right away
+            self.device = DeviceScheduler(self.arduino,
+                                          self.protocol,
+                                          lambda: self.mixer.clock.seconds,
+                                          lambda: not self.mixer.paused)
+            self.device.load(self.event_times - self.led_offset, sequence['frame'])
+            self.device.mute(self.arduino_muted)
+            self.device.start()
+
         self.on_start.emit()
         self.music_stream and self.music_stream.start()
         self.unpause()
-        self.wait_till(first_note.time)
+        self.wait_till(first_note.time / self.rate)
+
+        if self.device:
+            try:
+                self.dispatch(notes, sequence, checkpoints)
+                # The device still holds the last frames, the clock has to get there
+                self.need_to_die or self.wait_till(self.event_times[-1] - self.led_offset)
+            finally:
+                self.device.stop()
+                self.on_report.emit(self.report())
+            return
 
+        self.messages = self.protocol.encode_frames(sequence['frame'])
+        self.recorder.clear()
+        self.writer = SerialWriter(self.arduino,
+                                   self.protocol,
+                                   lambda: self.mixer.clock.seconds,
+                                   self.recorder,
+                                   self.late_policy)
+        self.writer.start()
+        try:
+            self.dispatch(notes, sequence, checkpoints)
+            self.need_to_die or self.writer.flush(FLUSH_TIMEOUT)
+        finally:
+            self.writer.stop()
+            self.on_report.emit(self.report())
+
+    def report(self) -> str:
+        """How the frames of the last play went out"""
+        lines = [self.pin_warning] if self.pin_warning else []
+        if self.device:
+            lines.append(self.device.report())
+        elif self.writer:
+            lines += [self.recorder.report(), self.writer.report()]
+        return '\n'.join(lines) or 'Nothing played'
+
+    def dispatch(self, notes, sequence: np.ndarray, checkpoints: np.ndarray):
+        times = self.event_times
         current_index = 0
         while current_index < len(sequence):
-            event = sequence[current_index]
-            self.wait_till(event.time)
-            self.on_write.emit(event)
-            self.arduino and not self.arduino_muted and self.arduino.write(event.arduino_message)
+            event = self.to_note_event(sequence[current_index], notes)
+            self.wait_till(times[current_index] - self.led_offset)
             if self.need_to_die:
                 return
             if self.need_to_update_position:
-                current_index = [
-                    index
-                    for index, event in enumerate(sequence)
-                    if event.time >= self.mixer.current_time
-                ][0]
                 self.need_to_update_position = False
+                # The callback may not have taken the seek yet, so don't trust the clock for it
+                frame, self.seek_frame = self.seek_frame, None
+                position = self.mixer.clock.seconds if frame is None else frame / self.mixer.sample_rate
+                # A rate switch also lands here, with the times scaled anew
+                times = self.event_times
+                current_index = int(np.searchsorted(times, position + self.led_offset))
+                state = self.pin_state_at(sequence, checkpoints, current_index).tobytes()
+                if self.device:
+                    self.device.seek(current_index, state, times - self.led_offset)
+                    self.on_resync.emit(state)
+                    continue
+                self.writer.clear()
+                self.resync(state)
+                continue
+            self.on_write.emit(event)
+            if not self.device:
+                self.write(event.arduino_message, times[current_index] - self.led_offset, self.messages[current_index])
             current_index += 1
 
-    def inject_claps(self, notes):
+    def write(self, frame: bytes, deadline: Optional[float] = None, message: Optional[bytes] = None):
+        """Hand `frame` to the writer thread, `deadline` is when it is due on the audio clock"""
+        if self.arduino_muted or self.writer is None:
+            return
+        self.writer.put(frame, self.mixer.clock.seconds if deadline is None else deadline, message)
+
+    def resync(self, state: bytes):
+        """Send the full pin state after a seek, the Arduino only ever hears changes otherwise"""
+        self.on_resync.emit(state)
+        self.write(state)
+
+    def clap_track(self, rate: float) -> Tuple[int, np.ndarray]:
+        if rate not in self.clap_tracks:
+            notes = self.timeline.notes
+            notes = notes.with_times(notes.times / rate)
+            self.clap_tracks[rate] = render_claps(notes, self.clap_mapper, DEFAULT_SAMPLE_RATE)
+        return self.clap_tracks[rate]
+
+    def inject_claps(self):
         if self.clap_mapper:
-            for row in notes:
-                self.mixer.add_sound(self.clap_mapper(row), row.time)
+            start_frame, track = self.clap_track(self.rate)
+            self.mixer.add_track(track, start_frame, voice='claps')
 
     def cleanup(self):
+        self.writer and self.writer.stop()
+        self.device and self.device.stop()
         self.music_stream and self.music_stream.stop()
+        self.audio_source and self.audio_source.stop()
         self.on_end.emit()
         # self.disconnect()
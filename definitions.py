@@ -1,15 +1,25 @@
 import collections
 import functools
+import os
 
 from PyQt5 import QtCore
 
 DEFAULT_SAMPLE_RATE = 44100
+DISPLAY_REFRESH_RATE = 60
+# Music rates are snapped to steps of RATE_STEP in between
+MIN_RATE = 0.5
+MAX_RATE = 2.0
+RATE_STEP = 0.05
 BYTE_FALSE = b'\x00'
 BYTE_TRUE = b'\x01'
 BYTE_UNCHANGED = b'\xff'
 
 ARDUINO_MESSAGE_LENGTH = 12
 
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+GRAMMAR_PATH = os.path.join(PROJECT_DIR, 'sm_grammar.lark')
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'etternuino')
+
 LANE_PINS = {
     0: 11,
     1: 10,
@@ -17,6 +27,13 @@ LANE_PINS = {
     3: 8
 }
 
+# Lanes past the fourth need the pins past the 12 byte frame, see `frame_length`
+LANE_PIN_MAPS = {
+    4: LANE_PINS,
+    6: {**LANE_PINS, 4: 12, 5: 13},
+    8: {**LANE_PINS, 4: 12, 5: 13, 6: 14, 7: 15}
+}
+
 SNAP_PINS = {
     4: 7,
     8: 3,
@@ -44,8 +61,25 @@ def capture_exceptions(func):
     return decorator
 
 
-def make_blank_message():
-    blank_message = [BYTE_UNCHANGED] * ARDUINO_MESSAGE_LENGTH
+def snap_rate(rate: float) -> float:
+    rate = min(max(rate, MIN_RATE), MAX_RATE)
+    return round(round(rate / RATE_STEP) * RATE_STEP, 2)
+
+
+def cache_path(*parts) -> str:
+    """Path under `CACHE_DIR`, creating the parent directories on the way"""
+    path = os.path.join(CACHE_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def frame_length(lane_pins) -> int:
+    """Bytes in a message that covers every pin of `lane_pins` and `SNAP_PINS`"""
+    return max(ARDUINO_MESSAGE_LENGTH, *(pin + 1 for pin in lane_pins.values()), *(pin + 1 for pin in SNAP_PINS.values()))
+
+
+def make_blank_message(length=ARDUINO_MESSAGE_LENGTH):
+    blank_message = [BYTE_UNCHANGED] * length
     for pin in SNAP_PINS.values():
         blank_message[pin] = BYTE_FALSE
     return blank_message
@@ -0,0 +1,165 @@
+import collections
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+import serial
+
+from serial_protocol import (BITS_PER_BYTE, DEVICE_QUEUE_LENGTH, MAX_CHUNK_FRAMES, SYNC_LENGTH, CompactProtocol,
+                             pin_masks, to_microseconds)
+
+# Seconds of the timeline kept uploaded ahead of the clock
+LOOKAHEAD = 0.5
+# Queue slots left free, the firmware's clock may run a little behind ours
+QUEUE_MARGIN = 8
+# Seconds between sync packets and between upload rounds
+SYNC_INTERVAL = 0.1
+UPLOAD_INTERVAL = 0.01
+
+
+class DeviceScheduler(threading.Thread):
+    """Keeps firmware that fires frames from its own clock supplied with the next stretch of the timeline.
+
+    Frames are uploaded in chunks once they are less than `lookahead` seconds
+    ahead of `clock`, as long as the firmware has room for them. Every
+    `SYNC_INTERVAL` a sync packet tells the firmware where `clock` is and whether
+    it runs, so it corrects its drift and stands still while the music is paused.
+    USB latency and the host's scheduling then only delay uploads, not LEDs.
+    """
+
+    def __init__(self,
+                 port: Optional[serial.Serial],
+                 protocol: CompactProtocol,
+                 clock: Callable[[], float],
+                 running: Callable[[], bool],
+                 lookahead: float = LOOKAHEAD,
+                 capacity: int = DEVICE_QUEUE_LENGTH - QUEUE_MARGIN):
+        super().__init__(daemon=True)
+        if not protocol.schedules:
+            raise ValueError(f'Protocol version {protocol.version} does not schedule frames on the device')
+
+        self.port = port
+        self.protocol = protocol
+        self.clock = clock
+        self.running = running
+        self.lookahead = lookahead
+        self.capacity = capacity
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.times = np.zeros(0, dtype=np.float64)
+        self.timestamps = np.zeros(0, dtype=np.int64)
+        self.states = np.zeros(0, dtype=np.uint16)
+        self.changes = np.zeros(0, dtype=np.uint16)
+        self.pending_seek: Optional[Tuple[int, Optional[bytes]]] = None
+        self.next_index = 0
+        # Deadlines of uploaded frames the firmware may still be holding
+        self.in_flight = collections.deque()
+        self.last_sync = float('-inf')
+        self.muted = False
+        self.stopped = False
+
+        self.frames_uploaded = 0
+        self.chunks = 0
+        self.syncs = 0
+        self.bytes_written = 0
+
+    def load(self, times: np.ndarray, frames: np.ndarray):
+        """The timeline to play, `times` are deadlines on `clock` and `frames` legacy frames"""
+        states, changes = pin_masks(frames)
+        with self.lock:
+            self.states, self.changes = states, changes
+            self._set_times(times)
+            self.pending_seek = (0, None)
+        self.wakeup.set()
+
+    def seek(self, index: int, state: bytes, times: Optional[np.ndarray] = None):
+        """Drop what the firmware holds, write `state` right away and go on from event `index`.
+
+        New `times` replace the deadlines, after a rate or offset change.
+        """
+        with self.lock:
+            if times is not None:
+                self._set_times(times)
+            self.pending_seek = (index, state)
+        self.wakeup.set()
+
+    def mute(self, muted: bool):
+        with self.lock:
+            self.muted = muted
+            if not muted:
+                # Nothing was uploaded while muted, carry on from where the clock is
+                self.pending_seek = (int(np.searchsorted(self.times, self.clock())), None)
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+    def _set_times(self, times: np.ndarray):
+        self.times = np.asarray(times, dtype=np.float64)
+        self.timestamps = to_microseconds(self.times)
+
+    def write(self, message: bytes):
+        if self.port is not None:
+            self.port.write(message)
+        self.bytes_written += len(message)
+
+    def run(self):
+        while not self.stopped:
+            self.wakeup.wait(UPLOAD_INTERVAL)
+            self.wakeup.clear()
+            with self.lock:
+                seek, self.pending_seek = self.pending_seek, None
+                muted = self.muted
+
+            if seek is not None or muted and self.in_flight:
+                self.write(self.protocol.encode_clear())
+                self.in_flight.clear()
+            if seek is not None:
+                index, state = seek
+                state is None or self.write(self.protocol.encode(state))
+                self.next_index = index
+                self.last_sync = float('-inf')
+            if muted:
+                continue
+
+            if time.perf_counter() - self.last_sync >= SYNC_INTERVAL:
+                self.last_sync = time.perf_counter()
+                # Stamped with when the firmware will have read it, not when it was sent
+                running = self.running()
+                arrival = self.clock() + (SYNC_LENGTH * BITS_PER_BYTE / self.protocol.baud_rate if running else 0.)
+                self.write(self.protocol.encode_sync(int(to_microseconds(arrival)), running))
+                self.syncs += 1
+            self.upload(self.clock())
+
+    def upload(self, now: float):
+        while self.in_flight and self.in_flight[0] <= now:
+            self.in_flight.popleft()
+
+        end = int(np.searchsorted(self.times, now + self.lookahead, side='right'))
+        end = min(end, self.next_index + self.capacity - len(self.in_flight))
+        for start in range(self.next_index, end, MAX_CHUNK_FRAMES):
+            stop = min(start + MAX_CHUNK_FRAMES, end)
+            self.write(self.protocol.encode_chunk(self.timestamps[start:stop],
+                                                  self.states[start:stop],
+                                                  self.changes[start:stop]))
+            self.in_flight.extend(self.times[start:stop].tolist())
+            self.frames_uploaded += stop - start
+            self.chunks += 1
+        self.next_index = max(self.next_index, end)
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            'frames': self.frames_uploaded,
+            'chunks': self.chunks,
+            'syncs': self.syncs,
+            'bytes': self.bytes_written,
+            'in_flight': len(self.in_flight)
+        }
+
+    def report(self) -> str:
+        summary = self.summary()
+        return (f'{summary["frames"]} frames uploaded in {summary["chunks"]} chunks, {summary["syncs"]} syncs, '
+                f'{summary["bytes"]} bytes, {summary["in_flight"]} on the device')
@@ -0,0 +1,37 @@
+import os
+from typing import Optional
+
+import serial
+
+from simulated_device import SimulatedDevice, SimulatedPort
+
+# Where the Arduino is unless ETTERNUINO_DEVICE or the command line say otherwise
+DEFAULT_DEVICE = '/dev/ttyUSB0'
+DEVICE_VARIABLE = 'ETTERNUINO_DEVICE'
+# Device names that aren't serial ports
+NO_DEVICE = 'none'
+SIMULATED = 'simulated'
+SIMULATED_PTY = 'simulated-pty'
+
+
+def open_device(name: Optional[str] = None):
+    """The port frames go to, None to play without LEDs.
+
+    `name` is a serial port, `SIMULATED` for a `SimulatedDevice` in memory,
+    `SIMULATED_PTY` for one on a pseudo-terminal or `NO_DEVICE`. A port that
+    can't be opened is reported and played without, the app starts either way.
+    """
+    name = name or os.environ.get(DEVICE_VARIABLE, DEFAULT_DEVICE)
+    if name == NO_DEVICE:
+        return None
+    if name in (SIMULATED, SIMULATED_PTY):
+        device = SimulatedDevice(use_pty=name == SIMULATED_PTY)
+        device.start()
+        name = device.port_name
+        if name is None:
+            return SimulatedPort(device)
+    try:
+        return serial.Serial(name)
+    except serial.SerialException as e:
+        print(f'Playing without LEDs, could not open {name}: {e}')
+        return None
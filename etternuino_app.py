@@ -5,7 +5,8 @@ from PyQt5 import QtWidgets
 import GUI.etternuino_main.etternuino_main
 
 app = QtWidgets.QApplication([])
-main = GUI.etternuino_main.etternuino_main.EtternuinoMain()
+# An optional argument picks the device, a serial port or one of the names in `devices`
+main = GUI.etternuino_main.etternuino_main.EtternuinoMain(sys.argv[1] if len(sys.argv) > 1 else None)
 main.show()
 
 sys.exit(app.exec_())
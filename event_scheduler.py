@@ -0,0 +1,226 @@
+from fractions import Fraction
+from typing import Dict, Optional
+
+import numpy as np
+from attr import attrib, attrs
+
+from definitions import BYTE_FALSE, BYTE_UNCHANGED, LANE_PIN_MAPS, SNAP_PINS, frame_length, make_blank_message
+from simfile_parsing.basic_types import Time
+from simfile_parsing.note_field import NoteField, note_codes
+from simfile_parsing.rows import GlobalScheduledRow
+
+TAP_CODE = note_codes('1')[0]
+UNCHANGED = BYTE_UNCHANGED[0]
+# Events between two stored pin states, seeking replays at most this many
+CHECKPOINT_INTERVAL = 256
+
+
+def event_dtype(length: int) -> np.dtype:
+    """One frame of lane changes, bit n of `lanes` is set when lane n changes and of `states` when it turns on.
+
+    `row` is the note field row the snap pins come from.
+    """
+    return np.dtype([
+        ('time', np.float64),
+        ('lanes', np.uint16),
+        ('states', np.uint16),
+        ('row', np.int32),
+        ('frame', np.uint8, (length,))
+    ])
+
+
+@attrs
+class NoteEvent:
+    time: Time = attrib()
+    arduino_message: bytes = attrib()
+    row: GlobalScheduledRow = attrib()
+    # Every lane the frame changes, True for the ones it turns on
+    lane_states: Dict[int, bool] = attrib()
+
+
+class EventScheduler:
+    def __init__(self, lane_pins: Optional[Dict[int, int]] = None, frame_spacing: float = 0.):
+        self.microblink_duration = Fraction('0.01')
+        self.blink_duration = Fraction('0.12')
+        self.lane_pins = lane_pins
+        # Seconds a frame takes on the wire, closer frames would queue up behind each other
+        self.frame_spacing = frame_spacing
+
+    def lane_pin_map(self, lanes: int) -> Dict[int, int]:
+        return self.lane_pins or LANE_PIN_MAPS[lanes]
+
+    def schedule_events(self, notes: NoteField) -> np.ndarray:
+        """Every lane state change of `notes` as one time sorted array of `event_dtype`, one entry per frame"""
+        snap_sequence = self.obtain_snap_changes(notes)
+        lane_changes = self.obtain_lane_changes(notes)
+        ordered_events = self.compose_events(lane_changes, snap_sequence, notes)
+        ordered_events = self.space_events(ordered_events)
+        result = self.merge_events_into_messages(ordered_events, notes)
+
+        return result
+
+    @staticmethod
+    def obtain_snap_changes(notes: NoteField) -> np.ndarray:
+        """Rows that set the snap pins, which are the ones with something to hit"""
+        return np.flatnonzero(notes.any_of('124'))
+
+    def obtain_lane_changes(self, notes: NoteField):
+        """Times, lanes and states of every lane toggle, lane by lane.
+
+        Taps turn their lane on for `blink_duration`, everything else toggles it.
+        A blink still running when the next object of its lane comes in is cut
+        `microblink_duration` before it, so the lane visibly turns off in between.
+        """
+        active = np.isin(notes.objects, note_codes('12345'))
+        lanes, rows = np.nonzero(active)
+        taps = notes.objects[lanes, rows] == TAP_CODE
+        counts = np.where(taps, 2, 1)
+        starts = np.cumsum(counts) - counts
+
+        note_times = notes.times[rows]
+        times = np.repeat(note_times, counts)
+        times[starts[taps] + 1] += float(self.blink_duration)
+        change_lanes = np.repeat(lanes, counts)
+
+        previous = starts[1:] - 1
+        overlapping = (lanes[1:] == lanes[:-1]) & (times[previous] > note_times[1:])
+        times[previous[overlapping]] = note_times[1:][overlapping] - float(self.microblink_duration)
+
+        lane_starts = np.searchsorted(change_lanes, change_lanes, side='left')
+        states = (np.arange(times.size) - lane_starts) % 2 == 0
+        return times, change_lanes, states
+
+    @staticmethod
+    def compose_events(lane_changes, snap_sequence: np.ndarray, notes: NoteField):
+        times, lanes, states = lane_changes
+        if not snap_sequence.size:
+            empty = np.zeros(0, dtype=np.intp)
+            return times[empty], lanes[empty], states[empty], empty
+
+        snap_index = np.searchsorted(notes.times[snap_sequence], times, side='right') - 1
+        np.maximum(snap_index, 0, out=snap_index)
+        # Turning a lane off keeps the snap it was turned on with
+        last_on = np.maximum.accumulate(np.where(states, np.arange(times.size), 0))
+        snap_rows = snap_sequence[snap_index[last_on]]
+
+        # Offs first among changes at the same time, so the frame they end up in takes its snap from an on
+        order = np.lexsort((states, times))
+        return times[order], lanes[order], states[order], snap_rows[order]
+
+    def space_events(self, ordered_events):
+        """Keep frames `frame_spacing` apart by moving the ones that only turn lanes off.
+
+        A frame of offs too close to the one before it goes out `frame_spacing`
+        later, or together with the next frame if that one comes sooner. Offs never
+        join a frame that turns one of their lanes back on, the blink in between
+        would be lost, they squeeze in before it instead. Frames that turn
+        something on keep their time, they are what the music is synced to.
+        """
+        times, lanes, states, snap_rows = ordered_events
+        if not self.frame_spacing or not times.size:
+            return ordered_events
+
+        frame_times, frame_index = np.unique(times, return_inverse=True)
+        lane_bits = np.left_shift(1, lanes.astype(np.uint16), dtype=np.uint16)
+        on_lanes = np.zeros(frame_times.size, dtype=np.uint16)
+        off_lanes = np.zeros(frame_times.size, dtype=np.uint16)
+        np.bitwise_or.at(on_lanes, frame_index[states], lane_bits[states])
+        np.bitwise_or.at(off_lanes, frame_index[~states], lane_bits[~states])
+
+        spaced = frame_times.tolist()
+        on_lanes, off_lanes = on_lanes.tolist(), off_lanes.tolist()
+        merged = [False] * len(spaced)
+        previous = float('-inf')
+        # Lanes turned off by the frames merged into the current one so far
+        carried = 0
+        for index, frame_time in enumerate(frame_times.tolist()):
+            carried |= off_lanes[index]
+            if not on_lanes[index] and frame_time < previous + self.frame_spacing:
+                frame_time = previous + self.frame_spacing
+                if index + 1 < len(spaced) and frame_time + self.frame_spacing > spaced[index + 1]:
+                    if not carried & on_lanes[index + 1]:
+                        merged[index] = True
+                        continue
+                    # Crowds the next frame rather than merging into it, but stays before it
+                    frame_time = max(min(frame_time, spaced[index + 1] - self.frame_spacing), spaced[index])
+                spaced[index] = frame_time
+            previous = frame_time
+            carried = 0
+        # Merged frames go wherever the frame they joined ends up
+        for index in reversed(range(len(spaced) - 1)):
+            if merged[index]:
+                spaced[index] = spaced[index + 1]
+
+        times = np.array(spaced)[frame_index]
+        order = np.lexsort((states, times))
+        return times[order], lanes[order], states[order], snap_rows[order]
+
+    def merge_events_into_messages(self, ordered_events, notes: NoteField) -> np.ndarray:
+        """One frame per distinct time, later changes of a pin win over earlier ones"""
+        times, lanes, states, snap_rows = ordered_events
+        lane_pins = self.lane_pin_map(notes.lanes)
+        length = frame_length(lane_pins)
+
+        frames = np.empty((times.size, length), dtype=np.uint8)
+        frames[:] = np.frombuffer(b''.join(make_blank_message(length)), dtype=np.uint8)
+        pins = np.array([lane_pins[lane] for lane in range(notes.lanes)], dtype=np.intp)
+        frames[np.arange(times.size), pins[lanes]] = states
+        snap_masks = notes.snaps.pin_masks[snap_rows]
+        for pin in SNAP_PINS.values():
+            frames[:, pin] = snap_masks >> pin & 1
+
+        starts = np.flatnonzero(np.diff(times, prepend=-np.inf))
+        ends = np.append(starts[1:], times.size) - 1
+        lane_bits = np.left_shift(1, lanes.astype(np.uint16), dtype=np.uint16)
+
+        result = np.zeros(starts.size, dtype=event_dtype(length))
+        result['time'] = times[starts]
+        result['row'] = snap_rows[ends]
+        if not starts.size:
+            return result
+        result['lanes'] = np.bitwise_or.reduceat(lane_bits, starts)
+        result['states'] = np.bitwise_or.reduceat(np.where(states, lane_bits, 0), starts)
+        # Last change of every pin within each frame
+        last_set = np.maximum.reduceat(np.where(frames != UNCHANGED, np.arange(times.size)[:, None], -1), starts)
+        result['frame'] = np.where(last_set >= 0, frames[np.maximum(last_set, 0), np.arange(length)], UNCHANGED)
+
+        return result
+
+    @staticmethod
+    def to_note_event(event, notes: NoteField) -> NoteEvent:
+        lanes, states = int(event['lanes']), int(event['states'])
+        return NoteEvent(Time(float(event['time'])),
+                         event['frame'].tobytes(),
+                         notes.row(int(event['row']), GlobalScheduledRow),
+                         {lane: bool(states >> lane & 1) for lane in range(notes.lanes) if lanes >> lane & 1})
+
+    def initial_state(self, lanes: int) -> np.ndarray:
+        """Pins before the first event, every lane and snap pin off"""
+        lane_pins = self.lane_pin_map(lanes)
+        state = np.frombuffer(b''.join(make_blank_message(frame_length(lane_pins))), dtype=np.uint8).copy()
+        state[list(lane_pins.values())] = BYTE_FALSE[0]
+        return state
+
+    def state_checkpoints(self, events: np.ndarray, lanes: int) -> np.ndarray:
+        """Full pin state before event 0, `CHECKPOINT_INTERVAL`, 2 * `CHECKPOINT_INTERVAL`..."""
+        frames = events['frame']
+        initial = self.initial_state(lanes)
+        changed = frames != UNCHANGED
+        # Row of the last event that set each pin, -1 while none did
+        last_set = np.maximum.accumulate(np.where(changed, np.arange(len(frames))[:, None], -1), axis=0)
+        states = np.where(last_set >= 0, frames[np.maximum(last_set, 0), np.arange(initial.size)], initial)
+        return np.concatenate((initial[None], states[CHECKPOINT_INTERVAL - 1::CHECKPOINT_INTERVAL]))
+
+    @staticmethod
+    def pin_state_at(events: np.ndarray, checkpoints: np.ndarray, index: int) -> np.ndarray:
+        """Full pin state right before event `index`"""
+        checkpoint = index // CHECKPOINT_INTERVAL
+        state = checkpoints[checkpoint].copy()
+        replayed = events['frame'][checkpoint * CHECKPOINT_INTERVAL:index]
+        if not len(replayed):
+            return state
+        changed = replayed != UNCHANGED
+        touched = np.flatnonzero(changed.any(axis=0))
+        last_set = len(replayed) - 1 - changed[::-1, touched].argmax(axis=0)
+        state[touched] = replayed[last_set, touched]
+        return state
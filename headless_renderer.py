@@ -0,0 +1,160 @@
+import argparse
+import sys
+import time
+from typing import Dict, Optional, Union
+
+import numpy as np
+import soundfile as sf
+
+from audio_stream import BLOCK_FRAMES, CHANNELS, ArraySource
+from clap_mapper import BaseClapMapper, LaneCountClapMapper, SnapClapMapper, render_claps
+from definitions import DEFAULT_SAMPLE_RATE, snap_rate
+from event_scheduler import EventScheduler
+from mixer import Mixer
+from pcm_cache import PcmCache, decoded_blocks
+from serial_protocol import CompactProtocol, LegacyProtocol, cut_off_pins
+from simfile_parsing.basic_types import Time
+from simfile_parsing.complex_types import AssetReference
+from simfile_parsing.simfile_parser import AugmentedChart, parse_simfile
+from timeline_cache import CompiledTimeline, TimelineCache, compile_timeline
+
+CLAP_MAPPERS = {
+    'snap': SnapClapMapper,
+    'lanes': LaneCountClapMapper
+}
+PROTOCOLS = {
+    'legacy': LegacyProtocol,
+    'compact': CompactProtocol
+}
+
+
+class HeadlessRenderer(EventScheduler):
+    """Renders what `ChartPlayer` would play without a display, audio device or Arduino.
+
+    Music and claps go through the same `Mixer`, block after block as fast as
+    they are computed, into a float WAV file. The serial frames are the ones
+    `ChartPlayer` writes in `protocol`, one `<seconds> <hex frame>` line each, stamped with
+    the played time they would be written at.
+    """
+
+    def __init__(self,
+                 chart: AugmentedChart,
+                 audio: Optional[AssetReference] = None,
+                 sound_start_delta: Time = 0,
+                 clap_mapper: Optional[BaseClapMapper] = None,
+                 lane_pins: Optional[Dict[int, int]] = None,
+                 timeline_cache: Optional[TimelineCache] = None,
+                 pcm_cache: Optional[PcmCache] = None,
+                 led_offset: float = 0.,
+                 rate: float = 1.,
+                 protocol: Optional[Union[LegacyProtocol, CompactProtocol]] = None,
+                 sample_rate: int = DEFAULT_SAMPLE_RATE):
+        super().__init__(lane_pins)
+        self.chart = chart
+        self.audio = audio
+        self.sound_start_delta = sound_start_delta
+        self.clap_mapper = clap_mapper
+        self.timeline_cache = timeline_cache
+        self.pcm_cache = pcm_cache
+        self.led_offset = led_offset
+        self.rate = snap_rate(rate)
+        self.protocol = protocol or LegacyProtocol()
+        self.frame_spacing = self.protocol.frame_duration
+        self.sample_rate = sample_rate
+        self.timeline: Optional[CompiledTimeline] = None
+        # Set by `render_frames` when `protocol` can't carry every pin, like `ChartPlayer.pin_warning`
+        self.pin_warning: Optional[str] = None
+
+    def load_music(self) -> ArraySource:
+        if self.audio is None:
+            return ArraySource(np.zeros((0, CHANNELS), dtype=np.float32), self.sample_rate)
+
+        path = self.audio.full_path
+        pcm = None
+        if self.pcm_cache:
+            key = self.pcm_cache.key(path, self.sample_rate, self.rate)
+            pcm = self.pcm_cache.load(key)
+            if pcm is None:
+                pcm = self.pcm_cache.load(self.pcm_cache.decode(path, self.sample_rate, key, self.rate))
+        if pcm is None:
+            pcm = np.concatenate([np.zeros((0, CHANNELS), dtype=np.float32),
+                                  *decoded_blocks(path, self.sample_rate, self.rate)])
+        return ArraySource(pcm, self.sample_rate, self.sound_start_delta / self.rate)
+
+    def render_audio(self, wav_path: str, block_frames: int = BLOCK_FRAMES) -> int:
+        """Mix into `wav_path` until music and claps are over, returns the frames written"""
+        mixer = Mixer(self.load_music(), self.sample_rate)
+        if self.clap_mapper:
+            notes = self.timeline.notes
+            start_frame, track = render_claps(notes.with_times(notes.times / self.rate),
+                                              self.clap_mapper,
+                                              self.sample_rate)
+            mixer.add_track(track, start_frame, voice='claps')
+
+        block = np.zeros((block_frames, CHANNELS), dtype=np.float32)
+        with sf.SoundFile(wav_path, mode='w', samplerate=self.sample_rate, channels=CHANNELS, subtype='FLOAT') as wav:
+            while not mixer.finished:
+                start_frame = mixer.current_frame
+                mixer(block, block_frames, None, 0)
+                wav.write(block[:mixer.current_frame - start_frame])
+        return mixer.current_frame
+
+    def render_frames(self, frames_path: str) -> int:
+        """Write every serial frame to `frames_path`, returns how many there were"""
+        events = self.timeline.events
+        self.pin_warning = cut_off_pins(self.protocol, events['frame'].shape[1])
+        # Frames go out `led_offset` ahead of their notes, as in `ChartPlayer.dispatch`
+        times = events['time'] / self.rate - self.led_offset
+        with open(frames_path, mode='w') as frames_file:
+            for written_at, message in zip(times.tolist(), self.protocol.encode_frames(events['frame'])):
+                frames_file.write(f'{written_at:.6f} {message.hex()}\n')
+        return len(events)
+
+    def render(self, wav_path: Optional[str] = None, frames_path: Optional[str] = None):
+        self.timeline = compile_timeline(self.chart, self, self.sound_start_delta, self.timeline_cache)
+        frames = frames_path and self.render_frames(frames_path)
+        rendered = wav_path and self.render_audio(wav_path)
+        return rendered, frames
+
+
+def main(arguments) -> int:
+    parser = argparse.ArgumentParser(description='Render a chart to WAV and a serial frame log, no devices needed')
+    parser.add_argument('simfile')
+    parser.add_argument('chart', type=int, help='index of the chart in the simfile, from 0')
+    parser.add_argument('--wav', help='mixed music and claps')
+    parser.add_argument('--frames', help='serial frames, one "<seconds> <hex frame>" line each')
+    parser.add_argument('--claps', choices=sorted(CLAP_MAPPERS))
+    parser.add_argument('--protocol', choices=sorted(PROTOCOLS), default='legacy', help='how frames are encoded')
+    parser.add_argument('--rate', type=float, default=1.)
+    parser.add_argument('--led-offset', type=float, default=0., help='milliseconds frames are written early')
+    parser.add_argument('--no-music', action='store_true')
+    parser.add_argument('--cache', action='store_true', help='use the timeline and PCM caches')
+    options = parser.parse_args(arguments)
+
+    simfile = parse_simfile(options.simfile)
+    chart = simfile.charts[options.chart]
+    clap_mapper = options.claps and CLAP_MAPPERS[options.claps]()
+    renderer = HeadlessRenderer(chart,
+                                None if options.no_music else simfile.music,
+                                clap_mapper=clap_mapper,
+                                timeline_cache=TimelineCache() if options.cache else None,
+                                pcm_cache=PcmCache() if options.cache else None,
+                                led_offset=options.led_offset / 1000,
+                                rate=options.rate,
+                                protocol=PROTOCOLS[options.protocol]())
+
+    started = time.perf_counter()
+    rendered, frames = renderer.render(options.wav, options.frames)
+    elapsed = time.perf_counter() - started
+    if rendered:
+        seconds = rendered / renderer.sample_rate
+        print(f'{seconds:.1f} s of audio in {elapsed:.2f} s, {seconds / elapsed:.0f}x real time')
+    if frames is not None:
+        print(f'{frames} frames')
+    if renderer.pin_warning:
+        print(renderer.pin_warning)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
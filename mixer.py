@@ -1,67 +1,306 @@
+import bisect
+import collections
+import threading
 from fractions import Fraction
+from typing import Dict, Optional, Union
 
 import numpy as np
 import soundfile as sf
 from PyQt5 import QtCore
 
+from audio_stream import CHANNELS, ArraySource, StreamingDecoder
 from definitions import DEFAULT_SAMPLE_RATE
+from playback_clock import PlaybackClock
 from simfile_parsing.basic_types import Time
 
+# Gain changes, pauses and seeks fade over this many frames, about 6 ms
+FADE_FRAMES = 256
+# Scratch space preallocated for callback blocks, bigger blocks grow it once
+MAX_BLOCK_FRAMES = 8192
+
+
+class Voice(object):
+    """One part of the mix, its gain moves towards `target_gain` by 1 / FADE_FRAMES a frame"""
+
+    def __init__(self, gain: float = 1.):
+        self.gain = gain
+        self.muted = False
+        self.current_gain = gain
+
+    @property
+    def target_gain(self) -> float:
+        return 0. if self.muted else self.gain
+
+    @property
+    def silent(self) -> bool:
+        return self.current_gain == 0 and self.target_gain == 0
+
+    def apply_gain(self, block: np.ndarray, gains: np.ndarray, ramp: np.ndarray):
+        """Scale `block` in place, `gains` is scratch space and `ramp` holds 1, 2, 3..."""
+        target = self.target_gain
+        if self.current_gain == target:
+            if target != 1:
+                np.multiply(block, target, out=block)
+            return
+
+        frames = block.shape[0]
+        step = (1 if target > self.current_gain else -1) / FADE_FRAMES
+        gains = gains[:frames]
+        np.multiply(ramp[:frames], step, out=gains)
+        np.add(gains, self.current_gain, out=gains)
+        np.clip(gains, min(self.current_gain, target), max(self.current_gain, target), out=gains)
+        np.multiply(block, gains, out=block)
+        self.current_gain = float(gains[-1, 0])
+
+    def mix_into(self, out: np.ndarray, block: np.ndarray, gains: np.ndarray, ramp: np.ndarray):
+        if self.silent:
+            return
+        self.apply_gain(block, gains, ramp)
+        np.add(out, block, out=out)
+
+    def seek(self, frame: int):
+        pass
+
+    def stop(self):
+        pass
+
+
+class SourceVoice(Voice):
+    """Music from an `ArraySource` or a `StreamingDecoder`"""
+
+    def __init__(self, source: Union[ArraySource, StreamingDecoder], gain: float = 1.):
+        super().__init__(gain)
+        self.source = source
+
+    @property
+    def seeking(self) -> bool:
+        return self.source.seeking
+
+    @property
+    def exhausted(self) -> bool:
+        return self.source.exhausted
+
+    def render(self, block: np.ndarray, frame: int) -> int:
+        read = self.source.read_into(block)
+        block[read:] = 0
+        return read
+
+    def seek(self, frame: int):
+        self.source.seek(frame)
+
+    def stop(self):
+        self.source.stop()
+
+
+class TrackVoice(Voice):
+    """Prerendered tracks placed on the timeline, such as claps"""
+
+    def __init__(self, gain: float = 1.):
+        super().__init__(gain)
+        self.starts = []
+        self.tracks = []
+        self.longest = 0
+        self.end_frame = 0
+
+    def add(self, track: np.ndarray, start_frame: int):
+        if start_frame < 0:
+            track, start_frame = track[-start_frame:], 0
+        index = bisect.bisect_right(self.starts, start_frame)
+        self.starts.insert(index, start_frame)
+        self.tracks.insert(index, track.astype(np.float32, copy=False))
+        self.longest = max(self.longest, track.shape[0])
+        self.end_frame = max(self.end_frame, start_frame + track.shape[0])
+
+    def exhausted_at(self, frame: int) -> bool:
+        return frame >= self.end_frame
+
+    def render(self, block: np.ndarray, frame: int) -> int:
+        block[:] = 0
+        block_end = frame + block.shape[0]
+        first = bisect.bisect_right(self.starts, frame - self.longest)
+        last = bisect.bisect_left(self.starts, block_end)
+        for track_start, track in zip(self.starts[first:last], self.tracks[first:last]):
+            begin = max(track_start, frame)
+            end = min(track_start + track.shape[0], block_end)
+            if begin < end:
+                block[begin - frame:end - frame] += track[begin - track_start:end - track_start]
+        return block.shape[0]
+
 
 class Mixer(QtCore.QObject):
-    def __init__(self, data=np.zeros((60 * DEFAULT_SAMPLE_RATE, 2)), sample_rate=DEFAULT_SAMPLE_RATE):
+    """Audio callback mixing music, claps and metronome voices.
+
+    Other threads never touch callback state, they append commands to `commands`
+    and the callback applies them at the start of its next block. Apart from the
+    command tuples nothing is allocated while playing, blocks are mixed in
+    preallocated scratch arrays.
+    """
+
+    def __init__(self,
+                 source: Optional[Union[ArraySource, StreamingDecoder]] = None,
+                 sample_rate: int = DEFAULT_SAMPLE_RATE):
         super().__init__()
 
-        self.data = data.copy()
+        source = source or ArraySource(np.zeros((0, CHANNELS), dtype=np.float32), sample_rate)
         self.sample_rate = sample_rate
         self.current_frame = 0
-        self.muted = False
-        self.paused = False
+        self.voices = {
+            'music': SourceVoice(source),
+            'claps': TrackVoice(),
+            'metronome': TrackVoice()
+        }
+        # Pausing fades this out, playback stops once it is silent
+        self.master = Voice()
+
+        # deque appends and pops are atomic, one producer and the callback need no lock
+        self.commands = collections.deque()
+        self.requested_pause = False
+        self.requested_mutes = {name: False for name in self.voices}
+        self.ended = threading.Event()
+
+        self.block = np.zeros((MAX_BLOCK_FRAMES, CHANNELS), dtype=np.float32)
+        self.gains = np.zeros((MAX_BLOCK_FRAMES, 1), dtype=np.float32)
+        self.ramp = np.arange(1, MAX_BLOCK_FRAMES + 1, dtype=np.float32)[:, None]
+
+        self.clock = PlaybackClock(sample_rate)
 
     @classmethod
     def from_file(cls, source_file: str, sound_start: Time = 0):
-        data, sample_rate = sf.read(source_file, dtype='float32')
-        mixer = cls(data, sample_rate)
-
-        if sound_start < 0:
-            padded = np.zeros((mixer.sample_rate * abs(sound_start), mixer.data.shape[1]))
-            mixer.data = np.concatenate((padded, mixer.data))
-        else:
-            mixer.data = mixer.data[int(mixer.sample_rate * sound_start):]
-
-        return mixer
-
-    def add_sound(self, sound_data: np.ndarray, at_time: Time):
-        sample_start = int(self.sample_rate * at_time)
-        if sample_start + sound_data.shape[0] >= self.data.shape[0]:
-            offset = sample_start + sound_data.shape[0] - self.data.shape[0]
-            self.data = np.pad(
-                self.data,
-                (
-                    (0, offset),
-                    (0, 0)
-                ),
-                'constant'
-            )
-        self.data[sample_start: sample_start + sound_data.shape[0]] += sound_data
-
-        max_volume = np.max(self.data[sample_start: sample_start + sound_data.shape[0]],
-                            axis=0)[0]
-        if max_volume > 1:
-            self.data[sample_start: sample_start + sound_data.shape[0]] *= 1 / max_volume
+        data, sample_rate = sf.read(source_file, dtype='float32', always_2d=True)
+        return cls(ArraySource(data, sample_rate, sound_start), sample_rate)
+
+    @classmethod
+    def from_stream(cls, source: Union[ArraySource, StreamingDecoder]):
+        return cls(source, source.sample_rate)
+
+    @property
+    def source(self) -> Union[ArraySource, StreamingDecoder]:
+        return self.voices['music'].source
+
+    @property
+    def paused(self) -> bool:
+        return self.requested_pause
+
+    def muted(self, voice: str = 'music') -> bool:
+        return self.requested_mutes[voice]
+
+    def pause(self):
+        self.requested_pause = True
+        self.commands.append(('pause', True))
+
+    def resume(self):
+        self.requested_pause = False
+        self.commands.append(('pause', False))
+
+    def mute(self, voice: str = 'music'):
+        self.requested_mutes[voice] = True
+        self.commands.append(('mute', voice, True))
+
+    def unmute(self, voice: str = 'music'):
+        self.requested_mutes[voice] = False
+        self.commands.append(('mute', voice, False))
+
+    def set_gain(self, voice: str, gain: float):
+        self.commands.append(('gain', voice, gain))
+
+    def seek(self, frame: int):
+        self.clock.reset(frame)
+        self.ended.clear()
+        self.commands.append(('seek', frame))
+
+    def swap_voices(self, voices: Dict[str, Voice], frame: int):
+        """Replace some voices and continue from `frame`, in one step so no block mixes old and new"""
+        self.clock.reset(frame)
+        self.ended.clear()
+        self.commands.append(('swap', voices, frame))
+
+    def add_sound(self, sound_data: np.ndarray, at_time: Time, voice: str = 'claps'):
+        self.add_track(sound_data, int(self.sample_rate * at_time), voice)
+
+    def add_track(self, track: np.ndarray, start_frame: int, voice: str = 'claps'):
+        """Place `track` on the timeline from `start_frame` on, only before playback starts"""
+        self.voices[voice].add(track, start_frame)
+
+    def apply_commands(self):
+        while self.commands:
+            command, *arguments = self.commands.popleft()
+            if command == 'pause':
+                self.master.muted = arguments[0]
+            elif command == 'mute':
+                self.voices[arguments[0]].muted = arguments[1]
+            elif command == 'gain':
+                self.voices[arguments[0]].gain = arguments[1]
+            elif command == 'swap':
+                for name, voice in arguments[0].items():
+                    replaced = self.voices[name]
+                    voice.gain, voice.muted = replaced.gain, replaced.muted
+                    replaced.stop()
+                    self.voices[name] = voice
+            if command in ('seek', 'swap'):
+                self.current_frame = arguments[-1]
+                for voice in self.voices.values():
+                    voice.seek(self.current_frame)
+                    # Fade back in instead of starting mid-waveform
+                    voice.current_gain = 0.
+
+    def ensure_scratch(self, frames: int):
+        if frames > self.block.shape[0]:
+            self.block = np.zeros((frames, CHANNELS), dtype=np.float32)
+            self.gains = np.zeros((frames, 1), dtype=np.float32)
+            self.ramp = np.arange(1, frames + 1, dtype=np.float32)[:, None]
 
     def __call__(self, out_data: np.ndarray, frames: int, at_time, status: int):
+        self.apply_commands()
+        self.ensure_scratch(frames)
         sample_start = self.current_frame
+        advanced = self.mix(out_data, frames)
+        self.current_frame += advanced
+        self.clock.update(sample_start, advanced, at_time, running=advanced > 0)
 
-        if sample_start + frames > self.data.shape[0] or self.paused:
-            out_data.fill(0)
-        else:
-            if self.muted:
-                out_data.fill(0)
-            else:
-                out_data[:] = self.data[sample_start:sample_start + frames]
-            self.current_frame += frames
+    def mix(self, out_data: np.ndarray, frames: int) -> int:
+        """Fill `out_data`, returns how many frames the timeline moved"""
+        out_data.fill(0)
+        music = self.voices['music']
+        # Until a decoder catches up with a seek its ring holds audio of the old position
+        if self.master.silent or music.seeking:
+            return 0
+        if self.ended.is_set():
+            # The timeline runs on over silence, frames due after the audio ends still come due.
+            # The master fade advances too, so pausing still stops it
+            self.master.apply_gain(out_data[:frames], self.gains, self.ramp)
+            return frames
+
+        block = self.block[:frames]
+        read = music.render(block, self.current_frame)
+        # Short reads of a live decoder are underruns, only a finished song plays past its end
+        advanced = frames if music.exhausted else read
+        if not advanced:
+            return 0
+
+        out = out_data[:advanced]
+        music.mix_into(out, block[:advanced], self.gains, self.ramp)
+        for name, voice in self.voices.items():
+            if name != 'music' and not voice.exhausted_at(self.current_frame):
+                voice.render(block[:advanced], self.current_frame)
+                voice.mix_into(out, block[:advanced], self.gains, self.ramp)
+        self.master.apply_gain(out, self.gains, self.ramp)
+        np.clip(out, -1, 1, out=out)
+
+        end_frame = self.current_frame + advanced
+        if music.exhausted and all(voice.exhausted_at(end_frame)
+                                   for name, voice in self.voices.items() if name != 'music'):
+            self.ended.set()
+        return advanced
+
+    @property
+    def finished(self) -> bool:
+        return self.ended.is_set()
 
     @property
     def current_time(self) -> Time:
         return Time(Fraction(self.current_frame, self.sample_rate))
+
+    @property
+    def playback_time(self) -> Time:
+        """Time of what is being heard, behind `current_time` by the output latency"""
+        return Time(Fraction(self.clock.frame, self.sample_rate))
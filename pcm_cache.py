@@ -0,0 +1,114 @@
+import hashlib
+import os
+import threading
+from typing import Iterable, Optional
+
+import numpy as np
+
+from audio_stream import CHANNELS, file_blocks, probe, rated_source_rate
+from definitions import DEFAULT_SAMPLE_RATE, cache_path
+from resampler import resample_blocks
+
+PCM_DTYPE = np.float32
+# Two gigabytes is about three hours of 44.1 kHz stereo
+PCM_CACHE_SIZE_LIMIT = 2 * 1024 ** 3
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, mode='rb') as source:
+        for chunk in iter(lambda: source.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def decoded_blocks(path: str, sample_rate: int = DEFAULT_SAMPLE_RATE, rate: float = 1.) -> Iterable[np.ndarray]:
+    """All of `path` resampled to `sample_rate` and sped up `rate` times"""
+    source_rate, use_soundfile = probe(path)
+    blocks = file_blocks(path, 0, source_rate, use_soundfile)
+    return resample_blocks(blocks, rated_source_rate(source_rate, rate), sample_rate)
+
+
+class PcmCache(object):
+    """Decoded music as raw interleaved float32 stereo, one file per source file, sample rate and playback rate.
+
+    Files are only ever replaced as a whole, so several players can share the cache.
+    Loading a file touches it, the least recently loaded ones are evicted once the
+    cache grows past `size_limit` bytes.
+    """
+
+    def __init__(self, directory: Optional[str] = None, size_limit: int = PCM_CACHE_SIZE_LIMIT):
+        self.directory = directory or os.path.dirname(cache_path('pcm', ''))
+        self.size_limit = size_limit
+
+    @staticmethod
+    def key(path: str, sample_rate: int, rate: float = 1.) -> str:
+        key = f'{file_digest(path)}.{sample_rate}'
+        return key if rate == 1 else f'{key}.{rate:g}x'
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.pcm')
+
+    def load(self, key: str) -> Optional[np.ndarray]:
+        """Read-only memory map of the cached frames, None on a miss"""
+        path = self._path(key)
+        try:
+            data = np.memmap(path, dtype=PCM_DTYPE, mode='r')
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return data.reshape(-1, CHANNELS)
+
+    def store(self, key: str, blocks: Iterable[np.ndarray]):
+        path = self._path(key)
+        temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(temporary_path, mode='wb') as pcm_file:
+                for block in blocks:
+                    pcm_file.write(np.ascontiguousarray(block, dtype=PCM_DTYPE).tobytes())
+            os.replace(temporary_path, path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+        self.evict(keep=key)
+
+    def decode(self,
+               path: str,
+               sample_rate: int = DEFAULT_SAMPLE_RATE,
+               key: Optional[str] = None,
+               rate: float = 1.) -> str:
+        """Decode all of `path` into the cache, resampled to `sample_rate` and sped up `rate` times"""
+        key = key or self.key(path, sample_rate, rate)
+        self.store(key, decoded_blocks(path, sample_rate, rate))
+        return key
+
+    def decode_in_background(self,
+                             path: str,
+                             sample_rate: int = DEFAULT_SAMPLE_RATE,
+                             key: Optional[str] = None,
+                             rate: float = 1.) -> threading.Thread:
+        worker = threading.Thread(target=self.decode, args=(path, sample_rate, key, rate), daemon=True)
+        worker.start()
+        return worker
+
+    def evict(self, keep: Optional[str] = None):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pcm') and entry.name != f'{keep}.pcm':
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        if keep and os.path.exists(self._path(keep)):
+            total += os.path.getsize(self._path(keep))
+        for _, size, path in sorted(entries):
+            if total <= self.size_limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
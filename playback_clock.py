@@ -0,0 +1,61 @@
+import threading
+import time
+
+# Output latency above this is a bogus timestamp rather than a real buffer
+MAX_OUTPUT_LATENCY = 1.0
+
+
+def output_latency(time_info, fallback: float = 0.) -> float:
+    """Seconds until the first frame of the callback's buffer is heard, `fallback` when PortAudio doesn't know"""
+    dac_time = getattr(time_info, 'outputBufferDacTime', 0)
+    current_time = getattr(time_info, 'currentTime', 0)
+    if dac_time <= 0 or current_time <= 0:
+        return fallback
+    return min(max(dac_time - current_time, 0.), MAX_OUTPUT_LATENCY)
+
+
+class PlaybackClock(object):
+    """Frame that is being heard right now, extrapolated from the last audio callback.
+
+    Each callback anchors the clock: frame `anchor_frame` reaches the DAC at
+    `anchor_counter` on the `time.perf_counter` scale. In between, the position
+    advances at the sample rate but never past the frames handed to the device,
+    and never backwards unless `reset` moves it. Host APIs that don't timestamp
+    their buffers get `fallback_latency` instead, usually `OutputStream.latency`.
+    """
+
+    def __init__(self, sample_rate: int):
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+        self.anchor_frame = 0
+        self.anchor_counter = None
+        self.end_frame = 0
+        self.last_frame = 0
+        self.fallback_latency = 0.
+
+    def update(self, frame: int, frames: int, time_info, running: bool = True):
+        """Called from the audio callback with the first frame of its buffer"""
+        counter = time.perf_counter() + output_latency(time_info, self.fallback_latency)
+        with self.lock:
+            self.anchor_frame = frame
+            self.anchor_counter = counter if running else None
+            self.end_frame = frame + frames
+
+    def reset(self, frame: int):
+        with self.lock:
+            self.anchor_frame = self.end_frame = self.last_frame = frame
+            self.anchor_counter = None
+
+    @property
+    def frame(self) -> int:
+        with self.lock:
+            # Stopped clocks stay where they were last heard
+            if self.anchor_counter is not None:
+                elapsed = time.perf_counter() - self.anchor_counter
+                estimate = min(self.anchor_frame + int(elapsed * self.sample_rate), self.end_frame)
+                self.last_frame = max(self.last_frame, estimate)
+            return self.last_frame
+
+    @property
+    def seconds(self) -> float:
+        return self.frame / self.sample_rate
@@ -0,0 +1,118 @@
+from math import gcd
+from typing import Iterable, Iterator
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Filter taps per polyphase branch, i.e. input frames every output frame is computed from
+RESAMPLER_TAPS = 32
+KAISER_BETA = 8.6
+# Largest period matrix, in elements, before falling back to gathering windows frame by frame
+MAX_PERIOD_MATRIX = 1 << 22
+
+
+def polyphase_bank(up: int, down: int, taps: int = RESAMPLER_TAPS) -> np.ndarray:
+    """Kaiser windowed-sinc lowpass split into `up` branches, reversed to be dotted with ascending frames"""
+    length = taps * up
+    cutoff = 0.5 / max(up, down)
+    t = np.arange(length) - length / 2
+    prototype = 2 * cutoff * np.sinc(2 * cutoff * t) * np.kaiser(length, KAISER_BETA) * up
+    bank = prototype.reshape(taps, up).T
+    return np.ascontiguousarray(bank[:, ::-1], dtype=np.float32)
+
+
+class Resampler(object):
+    """Rational polyphase resampler that converts a stream of blocks.
+
+    Output frame n is centered on input frame n * source_rate / target_rate.
+    Every `down` input frames yield one period of `up` output frames that all use
+    the same weights, so whole periods are computed as one matrix product of
+    strided input windows. `process` returns the periods whose input is complete
+    and `flush` the rest once the input ends.
+    """
+
+    def __init__(self, source_rate: int, target_rate: int, taps: int = RESAMPLER_TAPS, channels: int = 2):
+        divisor = gcd(source_rate, target_rate)
+        self.up = target_rate // divisor
+        self.down = source_rate // divisor
+        self.taps = taps
+        self.bank = polyphase_bank(self.up, self.down, taps)
+
+        # Window of the r-th output of a period starts `starts[r]` frames after the period does
+        positions = np.arange(self.up) * self.down + taps * self.up // 2
+        self.phases = positions % self.up
+        self.starts = positions // self.up - taps + 1
+        self.first = int(self.starts.min())
+        self.span = int(self.starts.max()) + taps - self.first
+        self.matrix = None
+        if self.span * self.up <= MAX_PERIOD_MATRIX:
+            self.matrix = np.zeros((self.span, self.up), dtype=np.float32)
+            for output, (phase, start) in enumerate(zip(self.phases, self.starts - self.first)):
+                self.matrix[start:start + taps, output] = self.bank[phase]
+
+        # Input frames from `buffer_start` on, the ones before it are no longer needed
+        self.buffer = np.zeros((-self.first, channels), dtype=np.float32)
+        self.buffer_start = self.first
+        self.next_period = 0
+        self.consumed = 0
+
+    @property
+    def passthrough(self) -> bool:
+        return self.up == self.down
+
+    def _periods(self, end: int) -> np.ndarray:
+        """Outputs of periods `next_period` up to `end`"""
+        count = end - self.next_period
+        if count <= 0:
+            return np.zeros((0, self.buffer.shape[1]), dtype=np.float32)
+        offset = self.next_period * self.down + self.first - self.buffer_start
+        if self.matrix is not None:
+            inputs = self.buffer[offset:offset + (count - 1) * self.down + self.span]
+            windows = sliding_window_view(inputs, self.span, axis=0)[::self.down]
+            result = (windows @ self.matrix).transpose(0, 2, 1)
+        else:
+            period_starts = offset + np.arange(count)[:, None] * self.down
+            frames = (period_starts + self.starts - self.first)[:, :, None] + np.arange(self.taps)
+            result = np.einsum('rk,prkc->prc', self.bank[self.phases], self.buffer[frames])
+
+        self.next_period = end
+        keep_from = self.next_period * self.down + self.first - self.buffer_start
+        self.buffer = self.buffer[keep_from:]
+        self.buffer_start += keep_from
+        return result.reshape(-1, self.buffer.shape[1])
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        if self.passthrough:
+            return block
+
+        self.buffer = np.concatenate((self.buffer, block.astype(np.float32, copy=False)))
+        self.consumed += block.shape[0]
+        available = self.buffer_start + self.buffer.shape[0]
+        end = max((available - self.first - self.span) // self.down + 1, self.next_period)
+        return self._periods(end)
+
+    def flush(self) -> np.ndarray:
+        """Outputs left once the input ended, there are ceil(inputs * up / down) in total"""
+        if self.passthrough:
+            return np.zeros((0, self.buffer.shape[1]), dtype=np.float32)
+
+        remaining = -(-self.consumed * self.up // self.down) - self.next_period * self.up
+        end = self.next_period - (-remaining // self.up)
+        needed = (end - 1) * self.down + self.first + self.span
+        padding = max(needed - self.buffer_start - self.buffer.shape[0], 0)
+        self.buffer = np.concatenate((self.buffer, np.zeros((padding, self.buffer.shape[1]), dtype=np.float32)))
+        return self._periods(end)[:max(remaining, 0)]
+
+
+def resample_blocks(blocks: Iterable[np.ndarray],
+                    source_rate: int,
+                    target_rate: int,
+                    channels: int = 2) -> Iterator[np.ndarray]:
+    resampler = Resampler(source_rate, target_rate, channels=channels)
+    for block in blocks:
+        result = resampler.process(block)
+        if result.shape[0]:
+            yield result
+    tail = resampler.flush()
+    if tail.shape[0]:
+        yield tail
@@ -0,0 +1,239 @@
+import time
+from typing import List, Optional, Sequence, Union
+
+import numpy as np
+import serial
+
+from definitions import ARDUINO_MESSAGE_LENGTH, BYTE_TRUE, BYTE_UNCHANGED
+
+# Every firmware starts out at this rate and only switches after a handshake
+LEGACY_BAUD_RATE = 9600
+DEFAULT_BAUD_RATE = 115200
+PROTOCOL_VERSION = 2
+# Version that queues timestamped frames and fires them from the firmware's own clock
+SCHEDULING_VERSION = 2
+
+# Handshake messages are printable, the legacy firmware only acts on bytes 0 and 1
+# and the 12 byte hello keeps it aligned to its 12 byte frames
+HANDSHAKE_MAGIC = b'ETN'
+HELLO_LENGTH = 12
+REPLY_LENGTH = 4
+# Opening the port resets most Arduinos, the bootloader takes a couple of seconds
+HANDSHAKE_TIMEOUT = 3.
+HELLO_INTERVAL = 0.25
+# Time the firmware gets to reopen its serial port at the new rate
+BAUD_SWITCH_DELAY = 0.05
+
+FRAME_START = 0xC0
+FRAME_TIMESTAMP = 0x01
+SYNC_START = 0xC2
+CHUNK_START = 0xC4
+CLEAR_START = 0xC6
+# Scheduled frames the firmware has room for
+DEVICE_QUEUE_LENGTH = 64
+# A whole chunk has to fit the Arduino's 64 byte receive buffer
+MAX_CHUNK_FRAMES = 7
+# Bytes of a sync packet, its timestamp is ahead by the time they take on the wire
+SYNC_LENGTH = 7
+MICROSECONDS = 1000000
+MAX_PINS = 16
+CRC8_POLYNOMIAL = 0x07
+# Start bit, 8 data bits and a stop bit
+BITS_PER_BYTE = 10
+
+
+def crc8_table(polynomial: int = CRC8_POLYNOMIAL) -> np.ndarray:
+    table = np.zeros(256, dtype=np.uint8)
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc << 1 ^ polynomial if crc & 0x80 else crc << 1) & 0xFF
+        table[byte] = crc
+    return table
+
+
+CRC8_TABLE = crc8_table()
+
+
+def crc8(data: Union[bytes, np.ndarray]) -> np.ndarray:
+    """CRC-8 of every row of `data`, or of all of it if it is a bytes object"""
+    rows = np.frombuffer(data, dtype=np.uint8)[None] if isinstance(data, bytes) else data
+    crc = np.zeros(rows.shape[0], dtype=np.uint8)
+    for column in range(rows.shape[1]):
+        crc = CRC8_TABLE[crc ^ rows[:, column]]
+    return crc
+
+
+def hello_message(baud_rate: int, version: int = PROTOCOL_VERSION) -> bytes:
+    return HANDSHAKE_MAGIC + f'{version}{baud_rate:07d}\n'.encode('ascii')
+
+
+class LegacyProtocol(object):
+    """One byte per pin, 0 and 1 set it and anything else leaves it alone.
+
+    What `sm_colors_test.ino` spoke before the handshake existed, and what is
+    left when the firmware doesn't answer one. That firmware reads frames of
+    exactly `ARDUINO_MESSAGE_LENGTH` bytes, so the pins past them, which 6 and
+    8 lane charts use, are cut off.
+    """
+    version = 0
+    baud_rate = LEGACY_BAUD_RATE
+    frame_bytes = ARDUINO_MESSAGE_LENGTH
+    max_pins = ARDUINO_MESSAGE_LENGTH
+    schedules = False
+
+    @property
+    def frame_duration(self) -> float:
+        """Seconds a frame takes on the wire"""
+        return self.frame_bytes * BITS_PER_BYTE / self.baud_rate
+
+    def encode(self, frame: bytes, timestamp: Optional[int] = None) -> bytes:
+        return frame[:self.frame_bytes]
+
+    def encode_frames(self, frames: np.ndarray, timestamps: Optional[Sequence[int]] = None) -> List[bytes]:
+        return [frame.tobytes() for frame in frames[:, :self.frame_bytes]]
+
+
+def pin_masks(frames: np.ndarray):
+    """Levels and write masks of every row of legacy `frames`, bit n for pin n"""
+    if frames.shape[1] > MAX_PINS:
+        raise ValueError(f'{frames.shape[1]} pins do not fit in a {MAX_PINS} bit mask')
+    weights = np.left_shift(1, np.arange(frames.shape[1], dtype=np.uint16), dtype=np.uint16)
+    states = ((frames == BYTE_TRUE[0]) * weights).sum(axis=1).astype(np.uint16)
+    changes = ((frames != BYTE_UNCHANGED[0]) * weights).sum(axis=1).astype(np.uint16)
+    return states, changes
+
+
+def cut_off_pins(protocol: Union[LegacyProtocol, 'CompactProtocol'], pins: int) -> Optional[str]:
+    """Warning about the pins of `pins` pin frames that `protocol` doesn't carry, None if it carries all"""
+    if pins <= protocol.max_pins:
+        return None
+    return (f'Protocol version {protocol.version} carries {protocol.max_pins} of {pins} pins, '
+            f'lanes on the pins past them stay dark')
+
+
+def to_microseconds(seconds) -> np.ndarray:
+    """Clock seconds as the wrapping u32 microseconds the firmware counts in"""
+    return np.round(np.asarray(seconds, dtype=np.float64) * MICROSECONDS).astype(np.int64) & 0xFFFFFFFF
+
+
+def _with_crc(records: np.ndarray) -> np.ndarray:
+    raw = records.view(np.uint8).reshape(records.size, -1)
+    raw[:, -1] = crc8(raw[:, :-1])
+    return raw
+
+
+class CompactProtocol(object):
+    """Compact frames, 6 bytes or 10 with a timestamp, all little endian:
+
+        start      FRAME_START, ORed with FRAME_TIMESTAMP when a timestamp follows
+        states     u16, bit n is the level of pin n
+        changes    u16, only pins with their bit set are written
+        timestamp  u32, microseconds on the host's playback clock, optional
+        crc        CRC-8 of everything before it
+
+    At 115200 baud a frame takes about half a millisecond on the wire, a legacy
+    frame at 9600 baud took 12.5.
+
+    Version 2 firmware queues timestamped frames and writes them once its own
+    clock gets there, see `device_scheduler`. It also reads
+
+        sync   SYNC_START, u32 clock microseconds, u8 running, crc
+        chunk  CHUNK_START, u8 count, count times (u16 states, u16 changes, u32 timestamp), crc
+        clear  CLEAR_START, crc, forgets every queued frame
+    """
+    frame_bytes = 6
+    max_pins = MAX_PINS
+
+    def __init__(self, baud_rate: int = DEFAULT_BAUD_RATE, version: int = PROTOCOL_VERSION):
+        self.baud_rate = baud_rate
+        self.version = version
+
+    @property
+    def schedules(self) -> bool:
+        return self.version >= SCHEDULING_VERSION
+
+    @property
+    def frame_duration(self) -> float:
+        return self.frame_bytes * BITS_PER_BYTE / self.baud_rate
+
+    def encode(self, frame: bytes, timestamp: Optional[int] = None) -> bytes:
+        frames = np.frombuffer(frame, dtype=np.uint8)[None]
+        return self.encode_frames(frames, None if timestamp is None else [timestamp])[0]
+
+    def encode_frames(self, frames: np.ndarray, timestamps: Optional[Sequence[int]] = None) -> List[bytes]:
+        """Encode every row of legacy `frames` at once"""
+        fields = [('start', 'u1'), ('states', '<u2'), ('changes', '<u2')]
+        if timestamps is not None:
+            fields.append(('timestamp', '<u4'))
+        records = np.zeros(frames.shape[0], dtype=fields + [('crc', 'u1')])
+        records['start'] = FRAME_START if timestamps is None else FRAME_START | FRAME_TIMESTAMP
+        records['states'], records['changes'] = pin_masks(frames)
+        if timestamps is not None:
+            records['timestamp'] = np.asarray(timestamps, dtype=np.int64) & 0xFFFFFFFF
+        return [row.tobytes() for row in _with_crc(records)]
+
+    @staticmethod
+    def encode_chunk(timestamps: np.ndarray, states: np.ndarray, changes: np.ndarray) -> bytes:
+        """Up to `MAX_CHUNK_FRAMES` scheduled frames in one packet"""
+        count = len(timestamps)
+        if not 0 < count <= MAX_CHUNK_FRAMES:
+            raise ValueError(f'Chunks carry 1 to {MAX_CHUNK_FRAMES} frames, not {count}')
+        record = np.zeros(1, dtype=[('start', 'u1'),
+                                    ('count', 'u1'),
+                                    ('frames', [('states', '<u2'), ('changes', '<u2'), ('timestamp', '<u4')], (count,)),
+                                    ('crc', 'u1')])
+        record['start'] = CHUNK_START
+        record['count'] = count
+        record['frames']['states'] = states
+        record['frames']['changes'] = changes
+        record['frames']['timestamp'] = timestamps
+        return _with_crc(record).tobytes()
+
+    @staticmethod
+    def encode_sync(timestamp: int, running: bool) -> bytes:
+        record = np.zeros(1, dtype=[('start', 'u1'), ('timestamp', '<u4'), ('running', 'u1'), ('crc', 'u1')])
+        record['start'] = SYNC_START
+        record['timestamp'] = timestamp & 0xFFFFFFFF
+        record['running'] = running
+        return _with_crc(record).tobytes()
+
+    @staticmethod
+    def encode_clear() -> bytes:
+        return bytes((CLEAR_START, int(crc8(bytes((CLEAR_START,)))[0])))
+
+
+def negotiate(port: serial.Serial,
+              baud_rate: int = DEFAULT_BAUD_RATE,
+              timeout: float = HANDSHAKE_TIMEOUT) -> Union[LegacyProtocol, CompactProtocol]:
+    """Ask the firmware on `port` for the compact protocol at `baud_rate`.
+
+    The hello is repeated until the firmware answers with `HANDSHAKE_MAGIC` and
+    the version it speaks, then both ends switch to `baud_rate`. Firmware that
+    stays silent gets legacy frames at the rate the port is open at.
+    """
+    hello = hello_message(baud_rate)
+    previous_timeout = port.timeout
+    port.timeout = HELLO_INTERVAL
+    port.reset_input_buffer()
+    received = b''
+    deadline = time.perf_counter() + timeout
+    try:
+        while time.perf_counter() < deadline:
+            port.write(hello)
+            # Boot messages and line noise may come first
+            received = received[-REPLY_LENGTH:] + port.read(REPLY_LENGTH)
+            start = received.find(HANDSHAKE_MAGIC)
+            if start < 0 or len(received) < start + REPLY_LENGTH:
+                continue
+            version = received[start + len(HANDSHAKE_MAGIC)] - ord('0')
+            if version < 1:
+                break
+            port.flush()
+            port.baudrate = baud_rate
+            time.sleep(BAUD_SWITCH_DELAY)
+            port.reset_input_buffer()
+            return CompactProtocol(baud_rate, min(version, PROTOCOL_VERSION))
+    finally:
+        port.timeout = previous_timeout
+    return LegacyProtocol()
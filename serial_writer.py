@@ -0,0 +1,176 @@
+import collections
+import threading
+import time
+from typing import Callable, Dict, Optional, Union
+
+import numpy as np
+import serial
+
+from definitions import BYTE_UNCHANGED
+from serial_protocol import CompactProtocol, LegacyProtocol
+from sync_recorder import SyncRecorder
+
+# What happens to a frame that is already late when the writer gets to it:
+# send it anyway, fold it into the frame queued after it, or drop it if later
+# queued frames set every pin it sets
+LATE_POLICIES = ('send', 'merge', 'drop')
+# Seconds past its deadline a frame counts as late
+LATE_AFTER = 0.005
+QUEUE_CAPACITY = 64
+# Seconds `bytes_per_second` is averaged over
+RATE_WINDOW = 1.
+
+
+def merge_frames(earlier: bytes, later: bytes) -> bytes:
+    """One frame with the effect of writing `earlier` and then `later`"""
+    earlier, later = np.frombuffer(earlier, dtype=np.uint8), np.frombuffer(later, dtype=np.uint8)
+    return np.where(later != BYTE_UNCHANGED[0], later, earlier).astype(np.uint8).tobytes()
+
+
+class SerialWriter(threading.Thread):
+    """Writes frames to the Arduino from its own thread, so a stalled port never holds up the scheduler.
+
+    Frames are queued as legacy frames with the clock time they are due at and,
+    usually, their message already encoded with `protocol` for the whole
+    timeline at once. Only frames without one, like merged frames, are encoded
+    right before they are written. A full queue folds the new frame into the
+    last queued one instead of blocking. Every write is recorded in `recorder`,
+    late ones are handled by `late_policy`.
+    """
+
+    def __init__(self,
+                 port: Optional[serial.Serial],
+                 protocol: Union[LegacyProtocol, CompactProtocol],
+                 clock: Callable[[], float],
+                 recorder: Optional[SyncRecorder] = None,
+                 late_policy: str = 'send',
+                 late_after: float = LATE_AFTER,
+                 capacity: int = QUEUE_CAPACITY):
+        super().__init__(daemon=True)
+        if late_policy not in LATE_POLICIES:
+            raise ValueError(f'Unknown late frame policy {late_policy}, expected one of {LATE_POLICIES}')
+
+        self.port = port
+        self.protocol = protocol
+        self.clock = clock
+        self.recorder = recorder
+        self.late_policy = late_policy
+        self.late_after = late_after
+        self.capacity = capacity
+
+        self.pending = collections.deque()
+        self.condition = threading.Condition()
+        self.writing = False
+        self.stopped = False
+
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.late = 0
+        self.merged = 0
+        self.dropped = 0
+        self.overflows = 0
+        self.bytes_per_second = 0.
+        self.window_start = time.perf_counter()
+        self.window_bytes = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self.pending)
+
+    def put(self, frame: bytes, deadline: float, message: Optional[bytes] = None):
+        """Queue `frame` to be written at clock time `deadline`, never blocks. `message` is `frame` encoded"""
+        with self.condition:
+            if len(self.pending) >= self.capacity:
+                _, queued, _ = self.pending.pop()
+                frame, message = merge_frames(queued, frame), None
+                self.overflows += 1
+            self.pending.append((deadline, frame, message))
+            self.condition.notify_all()
+
+    def clear(self):
+        """Forget queued frames, after a seek they describe the wrong part of the chart"""
+        with self.condition:
+            self.pending.clear()
+            self.condition.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until everything queued is written, False on timeout"""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and not self.writing, timeout)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.pending.clear()
+            self.condition.notify_all()
+
+    def superseded(self, frame: bytes) -> bool:
+        """Whether queued frames set every pin `frame` sets"""
+        changed = np.frombuffer(frame, dtype=np.uint8) != BYTE_UNCHANGED[0]
+        for _, queued, _ in self.pending:
+            changed &= np.frombuffer(queued, dtype=np.uint8) == BYTE_UNCHANGED[0]
+        return not changed.any()
+
+    def next_frame(self):
+        """Deadline, frame and message to write next, applying the late policy on the way, None once stopped"""
+        with self.condition:
+            while True:
+                self.writing = False
+                self.condition.notify_all()
+                self.condition.wait_for(lambda: self.pending or self.stopped)
+                if self.stopped:
+                    return None
+
+                deadline, frame, message = self.pending.popleft()
+                self.writing = True
+                if self.clock() - deadline <= self.late_after:
+                    return deadline, frame, message
+
+                self.late += 1
+                if self.late_policy == 'merge' and self.pending:
+                    next_deadline, next_frame, _ = self.pending[0]
+                    self.pending[0] = (next_deadline, merge_frames(frame, next_frame), None)
+                    self.merged += 1
+                elif self.late_policy == 'drop' and self.superseded(frame):
+                    self.dropped += 1
+                else:
+                    return deadline, frame, message
+
+    def run(self):
+        while True:
+            scheduled = self.next_frame()
+            if scheduled is None:
+                return
+            deadline, frame, message = scheduled
+            message = message or self.protocol.encode(frame)
+            if self.port is not None:
+                self.port.write(message)
+            self.recorder and self.recorder.record(deadline, self.clock())
+            self.count(len(message))
+
+    def count(self, amount: int):
+        self.frames_written += 1
+        self.bytes_written += amount
+        self.window_bytes += amount
+        now = time.perf_counter()
+        if now - self.window_start >= RATE_WINDOW:
+            self.bytes_per_second = self.window_bytes / (now - self.window_start)
+            self.window_start, self.window_bytes = now, 0
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            'depth': self.depth,
+            'frames': self.frames_written,
+            'bytes': self.bytes_written,
+            'bytes_per_second': self.bytes_per_second,
+            'late': self.late,
+            'merged': self.merged,
+            'dropped': self.dropped,
+            'overflows': self.overflows
+        }
+
+    def report(self) -> str:
+        summary = self.summary()
+        return (f'{summary["frames"]} frames, {summary["bytes"]} bytes, {summary["bytes_per_second"]:.0f} B/s, '
+                f'{summary["late"]} late ({summary["merged"]} merged, {summary["dropped"]} dropped), '
+                f'{summary["overflows"]} overflows, {summary["depth"]} queued')
@@ -1,5 +1,8 @@
+import os
 from fractions import Fraction
+from typing import IO, Optional
 
+import attr
 from attr import attrib, attrs
 
 from simfile_parsing.basic_types import Beat, Measure
@@ -45,3 +48,34 @@ class Color(object):
             self.g + other.g,
             self.b + other.b
         )
+
+
+@attrs(cmp=False, frozen=True)
+class AssetReference(object):
+    """File mentioned by a simfile tag, opened only when somebody asks for it.
+
+    `path` is kept as written in the simfile and resolved against `base_dir`,
+    the folder of the simfile, so parsing never has to change the working directory.
+    Optional assets swallow IO errors on `open` the way missing banners always were.
+    """
+    path: str = attrib(converter=str)
+    base_dir: str = attrib(default='')
+    required: bool = attrib(default=True)
+
+    @property
+    def full_path(self) -> str:
+        return os.path.join(self.base_dir, self.path)
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.full_path)
+
+    def open(self, mode='rb') -> Optional[IO]:
+        try:
+            return open(self.full_path, mode=mode)
+        except IOError:
+            if self.required:
+                raise
+            return None
+
+    def relative_to(self, base_dir: str):
+        return attr.evolve(self, base_dir=base_dir)
@@ -0,0 +1,155 @@
+from fractions import Fraction
+from typing import Iterable, Iterator, List, Optional, Type
+
+import numpy as np
+from attr import attrib, attrs
+
+from simfile_parsing.basic_types import NoteObjects, Time
+from simfile_parsing.rows import GlobalRow, GlobalScheduledRow, GlobalTimedRow
+from simfile_parsing.snaps import SnapColumns
+
+NOTE_CHARACTERS = '012345M'
+CODE_CHARACTERS = np.frombuffer(NOTE_CHARACTERS.encode('ascii'), dtype=np.uint8)
+UNKNOWN_CODE = 255
+CHARACTER_CODES = np.full(256, UNKNOWN_CODE, dtype=np.uint8)
+CHARACTER_CODES[CODE_CHARACTERS] = np.arange(len(NOTE_CHARACTERS), dtype=np.uint8)
+
+
+def note_codes(characters: str) -> np.ndarray:
+    """Codes used in `NoteField.objects` for each of `characters`"""
+    return CHARACTER_CODES[np.frombuffer(characters.encode('ascii'), dtype=np.uint8)]
+
+
+@attrs(cmp=False, slots=True)
+class NoteField(object):
+    """Columnar note field of a chart.
+
+    Row `i` sits at global position `numerators[i] / denominators[i]`, kept reduced
+    so that the denominator is the snap of the row, and holds `objects[:, i]`,
+    one `NOTE_CHARACTERS` code per lane. `times` is only there once the chart is timed.
+    Row objects are only materialized on demand, see `row`.
+    """
+    numerators: np.ndarray = attrib()
+    denominators: np.ndarray = attrib()
+    objects: np.ndarray = attrib()
+    times: Optional[np.ndarray] = attrib(default=None)
+    _snaps: Optional[SnapColumns] = attrib(default=None, init=False, repr=False)
+
+    @classmethod
+    def empty(cls, lanes: int = 4):
+        return cls(np.zeros(0, dtype=np.int32),
+                   np.ones(0, dtype=np.int32),
+                   np.zeros((lanes, 0), dtype=np.uint8))
+
+    @classmethod
+    def from_measures(cls, measures: List[str], lanes: int):
+        """Note field of whitespace-free measure strings, each holding whole rows of `lanes` objects"""
+        rows_per_measure = np.array([len(measure) // lanes for measure in measures], dtype=np.int32)
+        if not rows_per_measure.size:
+            return cls.empty(lanes)
+
+        denominators = np.repeat(rows_per_measure, rows_per_measure)
+        measure_starts = np.cumsum(rows_per_measure) - rows_per_measure
+        local_positions = np.arange(denominators.size, dtype=np.int32) - np.repeat(measure_starts, rows_per_measure)
+        numerators = np.repeat(np.arange(rows_per_measure.size, dtype=np.int32), rows_per_measure) * denominators
+        numerators += local_positions
+
+        characters = np.frombuffer(''.join(measures).encode('ascii'), dtype=np.uint8)
+        objects = CHARACTER_CODES[characters].reshape(-1, lanes).T.copy()
+        return cls(*cls._reduce(numerators, denominators), objects)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[GlobalRow]):
+        rows = list(rows)
+        if not rows:
+            return cls.empty()
+
+        lanes = len(rows[0].objects)
+        times = None
+        if all(hasattr(row, 'time') for row in rows):
+            times = np.array([float(row.time) for row in rows], dtype=np.float64)
+        return cls(np.array([row.pos.numerator for row in rows], dtype=np.int32),
+                   np.array([row.pos.denominator for row in rows], dtype=np.int32),
+                   note_codes(''.join(row.objects for row in rows)).reshape(-1, lanes).T.copy(),
+                   times)
+
+    @staticmethod
+    def _reduce(numerators: np.ndarray, denominators: np.ndarray):
+        divisors = np.gcd(numerators, denominators)
+        return numerators // divisors, denominators // divisors
+
+    @property
+    def lanes(self) -> int:
+        return self.objects.shape[0]
+
+    @property
+    def positions(self) -> np.ndarray:
+        return self.numerators / self.denominators
+
+    @property
+    def snaps(self) -> SnapColumns:
+        """Snap columns of every row, computed once per note field"""
+        if self._snaps is None:
+            self._snaps = SnapColumns.from_denominators(self.denominators)
+        return self._snaps
+
+    @property
+    def nbytes(self) -> int:
+        arrays = (self.numerators, self.denominators, self.objects, self.times)
+        return sum(array.nbytes for array in arrays if array is not None)
+
+    def __len__(self) -> int:
+        return self.numerators.size
+
+    def any_of(self, characters: str) -> np.ndarray:
+        """Mask of the rows holding at least one of `characters` on any lane"""
+        return np.isin(self.objects, note_codes(characters)).any(axis=0)
+
+    def count_of(self, characters: str) -> int:
+        """Amount of objects among `characters` in the whole note field"""
+        return int(np.isin(self.objects, note_codes(characters)).sum())
+
+    def select(self, rows):
+        """Note field made of `rows`, a mask or an index array"""
+        return NoteField(self.numerators[rows],
+                         self.denominators[rows],
+                         self.objects[:, rows],
+                         None if self.times is None else self.times[rows])
+
+    def sorted(self):
+        return self.select(np.argsort(self.positions, kind='stable'))
+
+    def with_times(self, times: np.ndarray):
+        note_field = NoteField(self.numerators, self.denominators, self.objects, np.asarray(times, dtype=np.float64))
+        note_field._snaps = self._snaps
+        return note_field
+
+    def shifted(self, delta: Time):
+        return self.with_times(self.times + float(delta))
+
+    def objects_string(self, index: int) -> NoteObjects:
+        return NoteObjects(CODE_CHARACTERS[self.objects[:, index]].tobytes().decode('ascii'))
+
+    def row(self, index: int, row_type: Optional[Type[GlobalRow]] = None) -> GlobalRow:
+        """Materialize a single row, timed rows come out as `GlobalTimedRow` by default"""
+        row_type = row_type or (GlobalRow if self.times is None else GlobalTimedRow)
+        position = Fraction(int(self.numerators[index]), int(self.denominators[index]))
+        if row_type is GlobalRow:
+            return GlobalRow(self.objects_string(index), position)
+        return row_type(self.objects_string(index), position, Time(float(self.times[index])))
+
+    def rows(self, row_type: Optional[Type[GlobalRow]] = None) -> Iterator[GlobalRow]:
+        return (self.row(index, row_type) for index in range(len(self)))
+
+    def scheduled_rows(self) -> List[GlobalScheduledRow]:
+        return list(self.rows(GlobalScheduledRow))
+
+    def __getitem__(self, index: int) -> GlobalRow:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.row(index)
+
+    def __iter__(self) -> Iterator[GlobalRow]:
+        return self.rows()
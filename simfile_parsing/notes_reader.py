@@ -0,0 +1,115 @@
+import hashlib
+import mmap
+import re
+from typing import List, Optional, Tuple
+
+from simfile_parsing.note_field import NoteField
+
+COMMENT = re.compile(rb'//[^\n]*')
+NOTES_SECTION = re.compile(r'#NOTES:([^;]*);')
+SIGNED_NUMBER = re.compile(r'[+-]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?')
+INT = re.compile(r'\d+')
+
+# Must mirror the `#NOTES:` alternatives of sm_grammar.lark
+LANES_PER_CHART_TYPE = {
+    'dance-single': 4,
+    'dance-couple': 4,
+    'dance-solo': 6,
+    'dance-double': 8
+}
+NOTE_OBJECTS = frozenset('012345M')
+IGNORED_WHITESPACE = str.maketrans('', '', ' \t\f\r\n')
+
+ChartSection = Tuple[str, str, int, NoteField]
+
+
+class MalformedNotes(ValueError):
+    pass
+
+
+def read_simfile(file_path: str) -> Tuple[str, str]:
+    """Read a simfile through a memory map, stripping `//` comments in one pass.
+
+    Returns the text along with the sha256 of the file contents.
+    """
+    with open(file_path, mode='rb') as simfile:
+        try:
+            with mmap.mmap(simfile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                digest = hashlib.sha256(mapped).hexdigest()
+                stripped = COMMENT.sub(b'', mapped)
+        except ValueError:
+            # Empty files can't be mapped
+            digest = hashlib.sha256(b'').hexdigest()
+            stripped = b''
+    return stripped.decode('utf-8', errors='ignore'), digest
+
+
+def read_simfile_text(file_path: str) -> str:
+    return read_simfile(file_path)[0]
+
+
+def _phrase(field: str) -> Optional[str]:
+    phrase = field.strip(' \t\f\r\n')
+    if any(separator in phrase for separator in '\t\r\n'):
+        raise MalformedNotes(f'Ambiguous chart info {field!r}')
+    return phrase or None
+
+
+def _radar_values(field: str):
+    values = field.split(',')
+    if len(values) < 2 or not all(SIGNED_NUMBER.fullmatch(value.strip(' \t\f\r\n')) for value in values):
+        raise MalformedNotes(f'Bad radar values {field!r}')
+
+
+def read_note_field(note_data: str, lanes: int) -> NoteField:
+    measures = note_data.translate(IGNORED_WHITESPACE).split(',')
+    if len(measures) > 1 and not measures[-1]:
+        measures.pop()
+
+    for global_pos, objects in enumerate(measures):
+        if not objects or len(objects) % lanes or not NOTE_OBJECTS.issuperset(objects):
+            raise MalformedNotes(f'Bad measure {global_pos}')
+
+    return NoteField.from_measures(measures, lanes)
+
+
+def read_notes_section(section: str) -> ChartSection:
+    """Read the body of a `#NOTES:` tag the same way the grammar does, or raise `MalformedNotes`"""
+    fields = section.split(':')
+    if len(fields) != 6:
+        raise MalformedNotes(f'Expected 6 fields, got {len(fields)}')
+    chart_type, step_artist, diff_name, diff_value, radar_values, note_data = fields
+
+    lanes = LANES_PER_CHART_TYPE.get(chart_type.strip(' \t\f\r\n'))
+    if lanes is None:
+        raise MalformedNotes(f'Unknown chart type {chart_type!r}')
+
+    # ChartTransformer.notes only copes with a missing step artist
+    diff_name = _phrase(diff_name)
+    diff_value = diff_value.strip(' \t\f\r\n')
+    if diff_name is None or not INT.fullmatch(diff_value):
+        raise MalformedNotes('Missing difficulty')
+    _radar_values(radar_values)
+
+    return _phrase(step_artist) or '', diff_name, int(diff_value), read_note_field(note_data, lanes)
+
+
+def split_notes_sections(text: str) -> Optional[Tuple[str, List[ChartSection]]]:
+    """Cut every `#NOTES:` tag out of `text`.
+
+    Returns the remaining header text along with the read charts, in file order,
+    or None if any of the sections has to go through the grammar instead.
+    """
+    header = []
+    charts = []
+    last_end = 0
+    for match in NOTES_SECTION.finditer(text):
+        try:
+            charts.append(read_notes_section(match.group(1)))
+        except MalformedNotes:
+            return None
+        header.append(text[last_end:match.start()])
+        last_end = match.end()
+    header.append(text[last_end:])
+
+    return ''.join(header), charts
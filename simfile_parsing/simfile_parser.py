@@ -1,7 +1,7 @@
-import io
+import functools
+import hashlib
 import operator as op
 import os
-import re
 from collections import deque
 from fractions import Fraction
 from typing import List, Optional
@@ -10,10 +10,13 @@ import lark
 from PyQt5 import QtCore
 from attr import Factory, attrib, attrs
 
-from definitions import capture_exceptions
+from definitions import GRAMMAR_PATH, cache_path, capture_exceptions
 from simfile_parsing.basic_types import NoteObjects, Time
-from simfile_parsing.complex_types import MeasureMeasurePair, MeasureValuePair
+from simfile_parsing.complex_types import AssetReference, MeasureMeasurePair, MeasureValuePair
+from simfile_parsing.note_field import NoteField
+from simfile_parsing.notes_reader import read_simfile, split_notes_sections
 from simfile_parsing.rows import GlobalRow, GlobalTimedRow, LocalRow, PureRow
+from simfile_parsing.timing import TimingMap, max_deviation
 
 
 @attrs(cmp=False, auto_attribs=True)
@@ -21,7 +24,7 @@ class PureChart(object):
     step_artist: Optional[str] = None
     diff_name: str = 'Beginner'
     diff_value: int = 1
-    note_field: List[GlobalRow] = Factory(list)
+    note_field: NoteField = Factory(NoteField.empty)
 
 
 @attrs(cmp=False, auto_attribs=True)
@@ -29,15 +32,44 @@ class AugmentedChart(object):
     step_artist: Optional[str] = None
     diff_name: str = 'Beginner'
     diff_value: int = 1
-    note_field: List[GlobalTimedRow] = Factory(list)
+    note_field: NoteField = Factory(NoteField.empty)
     bpm_segments: List[MeasureValuePair] = Factory(list)
     stop_segments: List[MeasureMeasurePair] = Factory(list)
     offset: Time = 0
-
-    def time(self):
+    chart_index: int = 0
+    simfile_digest: Optional[str] = None
+    _timed_note_field: Optional[NoteField] = attrib(default=None, init=False, repr=False)
+    _timing_map: Optional[TimingMap] = attrib(default=None, init=False, repr=False)
+
+    @property
+    def timed_note_field(self) -> NoteField:
+        """Note field with times, computed on first access and kept afterwards"""
+        if self._timed_note_field is None:
+            self._timed_note_field = self.time()
+        return self._timed_note_field
+
+    @property
+    def timing_map(self) -> TimingMap:
+        if self._timing_map is None:
+            self._timing_map = TimingMap.from_segments(self.bpm_segments, self.stop_segments, self.offset)
+        return self._timing_map
+
+    def time(self, exact: bool = False) -> NoteField:
+        """Time the note field through `timing_map`, or with `exact` through the reference Fraction path"""
+        if exact:
+            return NoteField.from_rows(self.time_exact())
+
+        note_field = self.note_field.sorted()
+        return note_field.with_times(self.timing_map(note_field.positions))
+
+    def timing_deviation(self) -> float:
+        """Largest difference in seconds between the vectorized and the exact timing of this chart"""
+        return max_deviation(self.time().times, [row.time for row in self.time_exact()])
+
+    def time_exact(self) -> List[GlobalTimedRow]:
         bpm_segments = deque(sorted(self.bpm_segments, key=op.attrgetter('measure')))
         stop_segments = deque(sorted(self.stop_segments, key=op.attrgetter('measure')))
-        notefield = deque(sorted(self.note_field, key=op.attrgetter('pos')))
+        notefield = deque(self.note_field.sorted())
 
         # Time for serious state magic
         elapsed_time = 0
@@ -75,9 +107,9 @@ class AugmentedChart(object):
             elapsed_time += delta_time
             last_measure += delta_measure
 
-            augmented_notefield.append(GlobalTimedRow(**last_object.__dict__, time=elapsed_time - self.offset))
+            augmented_notefield.append(GlobalTimedRow(last_object.objects, last_object.pos, elapsed_time - self.offset))
 
-        self.note_field = augmented_notefield
+        return augmented_notefield
 
 
 @attrs(cmp=False)
@@ -87,10 +119,10 @@ class Simfile(object):
     artist: str = attrib(default="")
     genre: str = attrib(default="")
     credit: str = attrib(default="")
-    music: Optional[io.BufferedReader] = attrib(default=None)
-    banner: Optional[io.BufferedReader] = attrib(default=None)
-    bg: Optional[io.BufferedReader] = attrib(default=None)
-    cdtitle: Optional[io.BufferedReader] = attrib(default=None)
+    music: Optional[AssetReference] = attrib(default=None)
+    banner: Optional[AssetReference] = attrib(default=None)
+    bg: Optional[AssetReference] = attrib(default=None)
+    cdtitle: Optional[AssetReference] = attrib(default=None)
     sample_start: Time = attrib(default=0)
     sample_length: Time = attrib(default=10)
     display_bpm: str = '*'
@@ -98,14 +130,28 @@ class Simfile(object):
     stop_segments: List[MeasureMeasurePair] = attrib(factory=list)
     offset: Time = attrib(default=0, converter=Time)
     charts: List[AugmentedChart] = attrib(factory=list)
+    digest: Optional[str] = attrib(default=None)
 
+    asset_fields = ('music', 'banner', 'bg', 'cdtitle')
+
+    def add_chart(self, chart: PureChart):
+        self.charts.append(AugmentedChart(**chart.__dict__,
+                                          bpm_segments=self.bpm_segments,
+                                          stop_segments=self.stop_segments,
+                                          offset=self.offset,
+                                          chart_index=len(self.charts)))
+
+    def resolve_assets(self, base_dir: str):
+        for field in self.asset_fields:
+            asset = getattr(self, field)
+            if asset is not None:
+                setattr(self, field, asset.relative_to(base_dir))
 
-class ChartTransformer(lark.Transformer):
-    file_handles = set()
 
+class ChartTransformer(lark.Transformer):
     @staticmethod
     def extract_first(tree):
-        return tree.children[0]
+        return tree.children[0] if tree is not None else None
 
     @staticmethod
     def row(tokens):
@@ -120,29 +166,29 @@ class ChartTransformer(lark.Transformer):
 
     @staticmethod
     def measures(tokens):
-        return [
+        return NoteField.from_rows(
             GlobalRow(local_row.objects, global_pos + local_row.pos)
             for global_pos, measure in enumerate(tokens)
             for local_row in measure
-        ]
+        )
 
     @staticmethod
     def notes(tokens):
         try:
-            return PureChart(*map(ChartTransformer.extract_first, tokens[:3]), tokens[4])
+            chart = PureChart(*map(ChartTransformer.extract_first, tokens[:3]), tokens[4])
         except IndexError:
-            return PureChart('', *map(ChartTransformer.extract_first, tokens[:2]), tokens[3])
+            chart = PureChart('', *map(ChartTransformer.extract_first, tokens[:2]), tokens[3])
+        # Lark versions that keep placeholders for missing optionals hand us None instead
+        chart.step_artist = chart.step_artist or ''
+        return chart
 
     @staticmethod
     def unsafe_file(tokens):
-        return open(tokens[0], mode='rb')
+        return AssetReference(tokens[0], required=True)
 
     @staticmethod
     def safe_file(tokens):
-        try:
-            return open(tokens[0], mode='rb')
-        except IOError:
-            return None
+        return AssetReference(tokens[0], required=False)
 
     @staticmethod
     def simfile(tokens):
@@ -152,12 +198,7 @@ class ChartTransformer(lark.Transformer):
             if not token:
                 continue
             elif isinstance(token, PureChart):
-                new_chart = AugmentedChart(**token.__dict__,
-                                           bpm_segments=result.bpm_segments,
-                                           stop_segments=result.stop_segments,
-                                           offset=result.offset)
-                new_chart.time()
-                result.charts.append(new_chart)
+                result.add_chart(token)
             elif not token.children:
                 continue
             elif token.data == 'bpms':
@@ -208,6 +249,53 @@ class ChartTransformer(lark.Transformer):
     file = safe_file
 
 
+@functools.lru_cache(None)
+def grammar_digest(grammar_path: str = GRAMMAR_PATH) -> str:
+    with open(grammar_path, mode='rb') as grammar:
+        return hashlib.sha256(grammar.read()).hexdigest()
+
+
+@functools.lru_cache(None)
+def _build_sm_parser(digest: str) -> lark.Lark:
+    # Lark verifies the cached tables against the grammar itself, the digest only keeps
+    # the tables of different grammar revisions from overwriting each other.
+    return lark.Lark.open(GRAMMAR_PATH,
+                          parser='lalr',
+                          transformer=ChartTransformer(),
+                          start='simfile',
+                          cache=cache_path('grammar', f'sm_grammar.{digest[:16]}.lark-{lark.__version__}'))
+
+
+def get_sm_parser() -> lark.Lark:
+    """LALR parser for `sm_grammar.lark`, built once per process and once per grammar revision on disk"""
+    return _build_sm_parser(grammar_digest())
+
+
+def parse_simfile(file_path: str, fast_notes: bool = True) -> Simfile:
+    """Parse a simfile, safe to call from several threads at once.
+
+    With `fast_notes` the `#NOTES:` tags are read by `notes_reader` and only the
+    header goes through the grammar, unless any of them turns out to be malformed.
+    """
+    chart, digest = read_simfile(file_path)
+    split_chart = fast_notes and split_notes_sections(chart)
+
+    if not split_chart:
+        parsed_chart = get_sm_parser().parse(chart)
+    else:
+        header, charts = split_chart
+        parsed_chart = get_sm_parser().parse(header) if header.strip() else Simfile()
+        for chart_section in charts:
+            parsed_chart.add_chart(PureChart(*chart_section))
+
+    parsed_chart.resolve_assets(os.path.dirname(os.path.abspath(file_path)))
+    parsed_chart.digest = digest
+    for parsed in parsed_chart.charts:
+        parsed.simfile_digest = digest
+
+    return parsed_chart
+
+
 class SimfileParser(QtCore.QObject):
     parse_simfile = QtCore.pyqtSignal(str)
     simfile_parsed = QtCore.pyqtSignal(object)
@@ -215,25 +303,4 @@ class SimfileParser(QtCore.QObject):
     @QtCore.pyqtSlot(str)
     @capture_exceptions
     def perform_parsing(self, file_path):
-        sm_transformer = ChartTransformer()
-
-        this_dir = os.getcwd()
-
-        with open(file_path, encoding='utf-8', errors='ignore') as chart:
-            lines = chart.readlines()
-
-        chart = []
-        for line in lines:
-            chart.append(re.sub(r'(//.*$)', '', line))
-
-        chart = ''.join(chart)
-        try:
-            sm_parser = lark.Lark.open('sm_grammar.lark', parser='lalr', transformer=sm_transformer, start='simfile')
-            os.chdir(os.path.dirname(file_path))
-            parsed_chart = sm_parser.parse(chart)
-        except Exception:
-            raise
-        finally:
-            os.chdir(this_dir)
-
-        self.simfile_parsed.emit(parsed_chart)
+        self.simfile_parsed.emit(parse_simfile(file_path))
@@ -0,0 +1,107 @@
+from typing import List
+
+import numpy as np
+from attr import attrib, attrs
+
+from definitions import SNAP_PINS
+
+MAX_SNAP = 192
+
+# Row denominator -> snap it's shown as, anything else is a 192nd
+SNAP_CLASSES = {
+    1: 4,
+    2: 4,
+    3: 12,
+    4: 4,
+    8: 8,
+    12: 12,
+    16: 16,
+    24: 24,
+    32: 32,
+    48: 48,
+    64: 64
+}
+
+SNAP_ARDUINO_PINS = {
+    1: [SNAP_PINS[4]],
+    2: [SNAP_PINS[4]],
+    3: [SNAP_PINS[12]],
+    4: [SNAP_PINS[4]],
+    8: [SNAP_PINS[8]],
+    12: [SNAP_PINS[12]],
+    16: [SNAP_PINS[16]],
+    24: [SNAP_PINS[24]],
+    32: [SNAP_PINS[4], SNAP_PINS[8]],
+    48: [SNAP_PINS[4], SNAP_PINS[12]],
+    64: [SNAP_PINS[4], SNAP_PINS[16]],
+    96: [SNAP_PINS[8], SNAP_PINS[12]],
+    128: [SNAP_PINS[8], SNAP_PINS[16]],
+    192: [SNAP_PINS[12], SNAP_PINS[16]]
+}
+DEFAULT_ARDUINO_PINS = [SNAP_PINS[192]]
+
+SNAP_RGB = {
+    4: (255, 0, 0),
+    8: (0, 0, 255),
+    12: (120, 0, 255),
+    16: (255, 255, 0),
+    24: (255, 120, 255),
+    32: (255, 120, 0),
+    48: (0, 255, 255),
+    64: (0, 255, 0)
+}
+DEFAULT_RGB = (120, 120, 120)
+
+
+def pins_to_mask(pins) -> int:
+    mask = 0
+    for pin in pins:
+        mask |= 1 << pin
+    return mask
+
+
+def mask_to_pins(mask: int) -> List[int]:
+    return [pin for pin in range(int(mask).bit_length()) if mask >> pin & 1]
+
+
+# Lookup tables indexed by denominator (SNAP_VALUES) or by snap value (the rest)
+SNAP_VALUES = np.full(MAX_SNAP + 1, MAX_SNAP, dtype=np.uint8)
+SNAP_PIN_MASKS = np.full(MAX_SNAP + 1, pins_to_mask(DEFAULT_ARDUINO_PINS), dtype=np.uint16)
+SNAP_COLORS = np.tile(np.array(DEFAULT_RGB, dtype=np.uint8), (MAX_SNAP + 1, 1))
+
+for _denominator, _snap in SNAP_CLASSES.items():
+    SNAP_VALUES[_denominator] = _snap
+for _snap, _pins in SNAP_ARDUINO_PINS.items():
+    SNAP_PIN_MASKS[_snap] = pins_to_mask(_pins)
+for _snap, _rgb in SNAP_RGB.items():
+    SNAP_COLORS[_snap] = _rgb
+
+# Pin mask -> the colored snap that lights it, for reading snaps back from Arduino frames
+MASK_SNAPS = {int(SNAP_PIN_MASKS[_snap]): _snap for _snap in SNAP_RGB}
+
+
+def snap_values(denominators: np.ndarray) -> np.ndarray:
+    return SNAP_VALUES[np.minimum(denominators, MAX_SNAP)]
+
+
+def snap_value(denominator: int) -> int:
+    return int(SNAP_VALUES[min(denominator, MAX_SNAP)])
+
+
+def snap_from_frame(frame: bytes) -> int:
+    """Snap whose pins are set in an Arduino frame"""
+    pins = [pin for pin in SNAP_PINS.values() if frame[pin] == 1]
+    return MASK_SNAPS.get(pins_to_mask(pins), MAX_SNAP)
+
+
+@attrs(cmp=False, slots=True)
+class SnapColumns(object):
+    """Snap value, Arduino pin mask and RGB color of every row of a note field"""
+    values: np.ndarray = attrib()
+    pin_masks: np.ndarray = attrib()
+    colors: np.ndarray = attrib()
+
+    @classmethod
+    def from_denominators(cls, denominators: np.ndarray):
+        values = snap_values(denominators)
+        return cls(values, SNAP_PIN_MASKS[values], SNAP_COLORS[values])
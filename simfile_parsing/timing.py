@@ -0,0 +1,74 @@
+from fractions import Fraction
+from operator import attrgetter
+from typing import List
+
+import numpy as np
+from attr import attrib, attrs
+
+from simfile_parsing.basic_types import Time
+from simfile_parsing.complex_types import MeasureMeasurePair, MeasureValuePair
+
+
+@attrs(cmp=False)
+class TimingMap(object):
+    """Piecewise-linear measure -> seconds map of a chart.
+
+    Breakpoint `i` starts at `measures[i]`, where the chart is `seconds[i]` in
+    and advances `seconds_per_measure[i]` per measure until the next breakpoint.
+    Stops are breakpoints that only jump `seconds`, so like the exact path
+    they apply to everything strictly after their measure.
+    """
+    measures: np.ndarray = attrib()
+    seconds: np.ndarray = attrib()
+    seconds_per_measure: np.ndarray = attrib()
+
+    @classmethod
+    def from_segments(cls,
+                      bpm_segments: List[MeasureValuePair],
+                      stop_segments: List[MeasureMeasurePair],
+                      offset: Time = 0):
+        bpm_segments = sorted(bpm_segments, key=attrgetter('measure'))
+        # The first BPM holds from the very start of the chart, wherever it is placed
+        breakpoints = [(Fraction(0), Fraction(240, bpm_segments[0].value), Fraction(0))]
+        breakpoints += [
+            (max(segment.measure, 0), Fraction(240, segment.value), Fraction(0))
+            for segment in bpm_segments[1:]
+        ]
+        breakpoints += [
+            (max(segment.measure, 0), None, Fraction(240, segment.value))
+            for segment in stop_segments
+        ]
+        breakpoints.sort(key=lambda breakpoint: breakpoint[0])
+
+        measures = []
+        seconds = []
+        seconds_per_measure = []
+        elapsed_time = -Fraction(offset)
+        last_measure = Fraction(0)
+        last_slope = breakpoints[0][1]
+        for measure, slope, jump in breakpoints:
+            elapsed_time += last_slope * (measure - last_measure) + jump
+            last_measure = measure
+            last_slope = slope if slope is not None else last_slope
+
+            measures.append(measure)
+            seconds.append(elapsed_time)
+            seconds_per_measure.append(last_slope)
+
+        return cls(np.array(measures, dtype=np.float64),
+                   np.array(seconds, dtype=np.float64),
+                   np.array(seconds_per_measure, dtype=np.float64))
+
+    def __call__(self, positions: np.ndarray) -> np.ndarray:
+        """Seconds of every measure position in `positions`, all at once"""
+        index = np.searchsorted(self.measures, positions, side='left') - 1
+        np.maximum(index, 0, out=index)
+        return self.seconds[index] + self.seconds_per_measure[index] * (positions - self.measures[index])
+
+
+def max_deviation(times: np.ndarray, reference_times) -> float:
+    """Largest absolute difference in seconds between two timings of the same rows"""
+    if not len(times):
+        return 0.
+    reference = np.array([float(time) for time in reference_times], dtype=np.float64)
+    return float(np.max(np.abs(np.asarray(times, dtype=np.float64) - reference)))
@@ -0,0 +1,341 @@
+import collections
+import os
+import select
+import struct
+import threading
+import time
+from typing import Optional, Sequence
+
+import numpy as np
+
+from definitions import ARDUINO_MESSAGE_LENGTH, BYTE_FALSE, BYTE_TRUE, BYTE_UNCHANGED
+from serial_protocol import (BITS_PER_BYTE, CHUNK_START, CLEAR_START, DEVICE_QUEUE_LENGTH, FRAME_START,
+                             FRAME_TIMESTAMP, HANDSHAKE_MAGIC, HELLO_LENGTH, LEGACY_BAUD_RATE, MAX_CHUNK_FRAMES,
+                             MICROSECONDS, PROTOCOL_VERSION, SCHEDULING_VERSION, SYNC_LENGTH, SYNC_START, crc8)
+from sync_recorder import SyncRecorder
+
+# Pins the firmware drives, 0 and 1 are its serial port
+FIRST_PIN = 2
+LAST_PIN = 15
+# Sync errors past this many microseconds are a seek or a resume, the clock jumps instead of slewing
+SYNC_JUMP = 10000
+# Smaller sync errors are corrected by this fraction, so USB jitter averages out
+SYNC_SMOOTHING = 8
+# Seconds the firmware spends on every byte it reads, Serial.read and the bitwise CRC-8 on a 16 MHz AVR
+BYTE_PARSE_TIME = 4e-6
+# Seconds a digitalWrite takes there
+PIN_WRITE_TIME = 4e-6
+# Longest the simulation sleeps without checking for input
+POLL_INTERVAL = 0.01
+CHUNK_FRAME = struct.Struct('<HHI')
+# The only bytes in legacy frames
+LEGACY_VALUES = (BYTE_FALSE[0], BYTE_TRUE[0], BYTE_UNCHANGED[0])
+PACKET_LENGTHS = {
+    FRAME_START: 6,
+    FRAME_START | FRAME_TIMESTAMP: 10,
+    SYNC_START: SYNC_LENGTH,
+    CLEAR_START: 2
+}
+
+
+def wrapped_difference(later: int, earlier: int) -> int:
+    """`later - earlier` of two wrapping u32 microsecond counters"""
+    return (later - earlier + (1 << 31)) % (1 << 32) - (1 << 31)
+
+
+class SimulatedDevice(threading.Thread):
+    """What `sm_colors_test.ino` does, in software, so the serial path can be measured without an Arduino.
+
+    Bytes reach the firmware at the baud rate it currently runs at, and reading,
+    checking and acting on them keeps it busy for `byte_parse_time` per byte and
+    `pin_write_time` per pin written, during which nothing else happens. Every
+    pin write is logged in `writes` as (perf_counter, device clock microseconds,
+    states, changes), the time being when the modeled firmware gets it done.
+
+    With `use_pty` it sits on the far end of a pseudo-terminal, open `port_name`
+    with pyserial as if it were the Arduino. Otherwise talk to it through
+    `SimulatedPort`. `version` is what the handshake answers, 0 plays old
+    firmware that doesn't answer at all.
+    """
+
+    def __init__(self,
+                 version: int = PROTOCOL_VERSION,
+                 queue_length: int = DEVICE_QUEUE_LENGTH,
+                 use_pty: bool = True,
+                 byte_parse_time: float = BYTE_PARSE_TIME,
+                 pin_write_time: float = PIN_WRITE_TIME):
+        super().__init__(daemon=True)
+        self.master = self.slave = self.port_name = None
+        if use_pty:
+            # Unix only, the in-memory `SimulatedPort` works everywhere
+            import pty
+            import tty
+            self.master, self.slave = pty.openpty()
+            tty.setraw(self.slave)
+            self.port_name = os.ttyname(self.slave)
+        self.version = version
+        self.queue_length = queue_length
+        self.byte_parse_time = byte_parse_time
+        self.pin_write_time = pin_write_time
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.replied = threading.Condition()
+        self.replies = bytearray()
+        self.baud_rate = LEGACY_BAUD_RATE
+        self.compact = False
+        self.buffer = bytearray()
+        # When every byte of `buffer` is in the firmware's receive buffer, and when the wire is free again
+        self.arrivals = collections.deque()
+        self.wire_free = 0.
+        # When the firmware is done with what it is doing
+        self.busy_until = 0.
+        self.pins = np.zeros(LAST_PIN + 1, dtype=np.uint8)
+        # Scheduled frames as (timestamp, states, changes), in upload order
+        self.queue = collections.deque()
+        self.offset = 0
+        self.running = False
+        self.frozen = 0
+        self.writes = []
+        self.bytes_received = 0
+        self.packets = 0
+        self.bad_packets = 0
+        self.overflows = 0
+        self.busy_time = 0.
+        self.stopped = False
+
+    @staticmethod
+    def micros(now: float) -> int:
+        return int(now * MICROSECONDS) & 0xFFFFFFFF
+
+    def device_time(self, now: float) -> int:
+        return (self.micros(now) + self.offset) & 0xFFFFFFFF if self.running else self.frozen
+
+    def close(self):
+        self.stopped = True
+        self.wakeup.set()
+        with self.replied:
+            self.replied.notify_all()
+        self.is_alive() and self.join()
+        if self.master is not None:
+            os.close(self.master)
+            os.close(self.slave)
+
+    def receive(self, data: bytes, now: float):
+        """`data` was written to the port at perf_counter `now`"""
+        with self.lock:
+            byte_time = BITS_PER_BYTE / self.baud_rate
+            start = max(now, self.wire_free)
+            self.arrivals.extend(start + byte_time * np.arange(1, len(data) + 1))
+            self.wire_free = start + byte_time * len(data)
+            self.buffer += data
+            self.bytes_received += len(data)
+        self.wakeup.set()
+
+    def reply(self, data: bytes):
+        if self.master is not None:
+            os.write(self.master, data)
+            return
+        with self.replied:
+            self.replies += data
+            self.replied.notify_all()
+
+    def run(self):
+        while not self.stopped:
+            self.wait(min(max(self.next_event() - time.perf_counter(), 0.), POLL_INTERVAL))
+            self.step(time.perf_counter())
+
+    def wait(self, timeout: float):
+        if self.master is None:
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+            return
+        readable, _, _ = select.select([self.master], [], [], timeout)
+        if readable:
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                self.stopped = True
+                return
+            self.receive(data, time.perf_counter())
+
+    def next_event(self) -> float:
+        return min(self.next_packet()[1], self.next_due())
+
+    def next_packet(self):
+        """Length of the packet at the start of `buffer` and when its last byte arrives, inf while incomplete"""
+        with self.lock:
+            while self.buffer:
+                length = self.packet_length()
+                if length >= 0:
+                    break
+                # Stray bytes up to the next start byte are skipped
+                del self.buffer[0]
+                self.arrivals.popleft()
+            else:
+                return 0, float('inf')
+            if not length or len(self.buffer) < length:
+                return 0, float('inf')
+            return length, self.arrivals[length - 1]
+
+    def next_due(self) -> float:
+        """Perf_counter the first queued frame is due at, inf while the clock stands before it"""
+        if not self.queue:
+            return float('inf')
+        now = time.perf_counter()
+        remaining = wrapped_difference(self.queue[0][0], self.device_time(now))
+        if remaining <= 0:
+            return now + remaining / MICROSECONDS
+        return now + remaining / MICROSECONDS if self.running else float('inf')
+
+    def step(self, now: float):
+        """Do what the firmware gets to until `now`, in the order it would"""
+        while True:
+            length, complete = self.next_packet()
+            due = self.next_due()
+            if min(complete, due) > now:
+                return
+            if due <= complete:
+                self.fire(max(due, self.busy_until))
+                continue
+            with self.lock:
+                packet = bytes(self.buffer[:length])
+                del self.buffer[:length]
+                for _ in range(length):
+                    self.arrivals.popleft()
+            self.busy(max(complete, self.busy_until), length * self.byte_parse_time)
+            self.packets += 1
+            self.handle_packet(packet)
+
+    def busy(self, start: float, duration: float):
+        self.busy_until = start + duration
+        self.busy_time += duration
+
+    def packet_length(self) -> int:
+        """Bytes of the packet at the start of `buffer`, 0 if more are needed to tell, -1 for a stray byte"""
+        first = self.buffer[0]
+        if first == HANDSHAKE_MAGIC[0]:
+            return HELLO_LENGTH
+        if not self.compact:
+            # Like the firmware, skip what can't start a legacy frame to get back in step
+            return ARDUINO_MESSAGE_LENGTH if first in LEGACY_VALUES else -1
+        if first == CHUNK_START:
+            if len(self.buffer) < 2:
+                return 0
+            return 3 + self.buffer[1] * CHUNK_FRAME.size if 0 < self.buffer[1] <= MAX_CHUNK_FRAMES else -1
+        return PACKET_LENGTHS.get(first, -1)
+
+    def handle_packet(self, packet: bytes):
+        if packet[0] == HANDSHAKE_MAGIC[0]:
+            self.handshake(packet)
+        elif not self.compact:
+            self.write_legacy(packet)
+        elif crc8(packet[:-1])[0] != packet[-1]:
+            self.bad_packets += 1
+        else:
+            self.handle(packet)
+
+    def handshake(self, hello: bytes):
+        if not self.version or not hello.startswith(HANDSHAKE_MAGIC):
+            return
+        self.reply(HANDSHAKE_MAGIC + str(self.version).encode('ascii'))
+        with self.lock:
+            self.baud_rate = int(hello[len(HANDSHAKE_MAGIC) + 1:-1])
+        self.compact = True
+
+    def handle(self, packet: bytes):
+        start = packet[0]
+        if start in (FRAME_START, FRAME_START | FRAME_TIMESTAMP):
+            states, changes = struct.unpack_from('<HH', packet, 1)
+            if start == FRAME_START or self.version < SCHEDULING_VERSION:
+                self.write_pins(states, changes)
+            else:
+                self.schedule(struct.unpack_from('<I', packet, 5)[0], states, changes)
+        elif start == CHUNK_START:
+            for states, changes, timestamp in CHUNK_FRAME.iter_unpack(packet[2:-1]):
+                self.schedule(timestamp, states, changes)
+        elif start == SYNC_START:
+            self.sync(*struct.unpack_from('<IB', packet, 1))
+        elif start == CLEAR_START:
+            self.queue.clear()
+
+    def schedule(self, timestamp: int, states: int, changes: int):
+        if len(self.queue) == self.queue_length:
+            # Out of room, the oldest frame goes out early rather than not at all
+            self.overflows += 1
+            self.write_pins(*self.queue.popleft()[1:])
+        self.queue.append((timestamp, states, changes))
+
+    def sync(self, timestamp: int, running: bool):
+        now = self.micros(self.busy_until)
+        error = wrapped_difference(timestamp, (now + self.offset) & 0xFFFFFFFF)
+        if not self.running or abs(error) > SYNC_JUMP:
+            self.offset = timestamp - now
+        else:
+            self.offset += int(error / SYNC_SMOOTHING)
+        self.running = bool(running)
+        if not self.running:
+            self.frozen = timestamp
+
+    def fire(self, start: float):
+        self.busy_until = start
+        self.write_pins(*self.queue.popleft()[1:])
+
+    def write_legacy(self, frame: bytes):
+        pins = np.arange(FIRST_PIN, len(frame))
+        values = np.frombuffer(frame, dtype=np.uint8)[FIRST_PIN:]
+        states = int(np.left_shift(1, pins[values == BYTE_TRUE[0]]).sum())
+        changes = int(np.left_shift(1, pins[(values == BYTE_TRUE[0]) | (values == BYTE_FALSE[0])]).sum())
+        self.write_pins(states, changes)
+
+    def write_pins(self, states: int, changes: int):
+        changes &= (1 << LAST_PIN + 1) - (1 << FIRST_PIN)
+        self.busy(self.busy_until, bin(changes).count('1') * self.pin_write_time)
+        self.writes.append((self.busy_until, self.device_time(self.busy_until), states, changes))
+        for pin in range(FIRST_PIN, LAST_PIN + 1):
+            if changes >> pin & 1:
+                self.pins[pin] = states >> pin & 1
+
+    def lateness(self, times: Sequence[float], epoch: float) -> SyncRecorder:
+        """When pin writes got done against `times`, the schedule in seconds after perf_counter `epoch`, in order"""
+        recorder = SyncRecorder(max(len(times), 1))
+        for scheduled, (written, _, _, _) in zip(times, self.writes):
+            recorder.record(scheduled, written - epoch)
+        return recorder
+
+    def report(self) -> str:
+        return (f'{self.bytes_received} bytes in {self.packets} packets at {self.baud_rate} baud, '
+                f'{self.bad_packets} bad, {self.overflows} queue overflows, '
+                f'firmware busy {self.busy_time * 1000:.1f} ms')
+
+
+class SimulatedPort(object):
+    """Enough of `serial.Serial` for `negotiate`, `SerialWriter` and `DeviceScheduler`, wired straight to `device`"""
+
+    def __init__(self, device: SimulatedDevice, timeout: Optional[float] = None):
+        self.device = device
+        self.timeout = timeout
+        self.baudrate = LEGACY_BAUD_RATE
+        self.port = 'simulated'
+
+    def write(self, data: bytes) -> int:
+        self.device.receive(bytes(data), time.perf_counter())
+        return len(data)
+
+    def read(self, size: int = 1) -> bytes:
+        device = self.device
+        with device.replied:
+            device.replied.wait_for(lambda: len(device.replies) >= size or device.stopped, self.timeout)
+            data = bytes(device.replies[:size])
+            del device.replies[:size]
+        return data
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        with self.device.replied:
+            self.device.replies.clear()
+
+    def close(self):
+        self.device.close()
@@ -1,18 +1,234 @@
+// Lights lanes and snaps for etternuino.
+//
+// Starts at 9600 baud reading legacy frames of 12 bytes, one byte per pin where
+// 0 and 1 set the pin and 0xFF leaves it alone. The host may send a 12 byte hello,
+// "ETN", the protocol version and the baud rate as 7 digits and a newline. The
+// sketch answers "ETN" and the version it speaks, then reopens the port at that
+// rate and reads compact packets, see serial_protocol.py:
+//
+//   frame  0xC0, u16 states, u16 changes, CRC-8, written right away
+//   frame  0xC1, u16 states, u16 changes, u32 timestamp, CRC-8, queued
+//   sync   0xC2, u32 clock, u8 running, CRC-8
+//   chunk  0xC4, u8 count, count times (u16 states, u16 changes, u32 timestamp), CRC-8
+//   clear  0xC6, CRC-8
+//
+// Queued frames are written once the sketch's clock reaches their timestamp.
+// The clock is micros() shifted to the host's playback clock by sync packets
+// and stands still while the host says playback is paused.
+
+const int FIRST_PIN = 2;  // 0 and 1 are the serial port
+const int LAST_PIN = 15;
+const int LEGACY_FRAME_LENGTH = 12;
+const long LEGACY_BAUD_RATE = 9600;
+
+const byte PROTOCOL_VERSION = 2;
+const int HELLO_LENGTH = 12;
+const byte FRAME_START = 0xC0;
+const byte FRAME_TIMESTAMP = 0x01;
+const byte SYNC_START = 0xC2;
+const byte CHUNK_START = 0xC4;
+const byte CLEAR_START = 0xC6;
+const int FRAME_LENGTH = 6;
+const int TIMESTAMP_LENGTH = 4;
+const int SYNC_LENGTH = 7;
+const int CLEAR_LENGTH = 2;
+const int CHUNK_FRAME_LENGTH = 8;
+const int MAX_CHUNK_FRAMES = 7;  // 3 + 7 * 8 bytes fit the 64 byte receive buffer
+const int PACKET_LENGTH = 3 + MAX_CHUNK_FRAMES * CHUNK_FRAME_LENGTH;
+
+const int QUEUE_LENGTH = 64;
+const long SYNC_JUMP = 10000;  // Microseconds, bigger errors are a seek and the clock jumps
+const int SYNC_SMOOTHING = 8;  // Smaller ones are corrected by an eighth per sync
+
+struct Scheduled {
+  unsigned long timestamp;
+  unsigned int states;
+  unsigned int changes;
+};
+
+bool compact = false;
+byte buffer[PACKET_LENGTH];
+// Bytes of the current compact packet read so far and its length
+int received = 0;
+int expected = 0;
+
+Scheduled queue[QUEUE_LENGTH];
+int queue_head = 0;
+int queue_size = 0;
+
+long clock_offset = 0;
+bool clock_running = false;
+unsigned long frozen_clock = 0;
+
+byte crc8(const byte *data, int length) {
+  byte crc = 0;
+  for (int i = 0; i < length; i++) {
+    crc ^= data[i];
+    for (int bit = 0; bit < 8; bit++) {
+      crc = crc & 0x80 ? (crc << 1) ^ 0x07 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+unsigned int read_u16(const byte *data) {
+  return data[0] | (unsigned int) data[1] << 8;
+}
+
+unsigned long read_u32(const byte *data) {
+  return read_u16(data) | (unsigned long) read_u16(data + 2) << 16;
+}
+
+unsigned long device_clock() {
+  return clock_running ? micros() + clock_offset : frozen_clock;
+}
+
 void setup() {
-  for (int pin = 2; pin < 12; pin++) {
+  for (int pin = FIRST_PIN; pin <= LAST_PIN; pin++) {
     pinMode(pin, OUTPUT);
   }
-  Serial.begin(9600);
+  Serial.begin(LEGACY_BAUD_RATE);
+}
+
+void handshake() {
+  Serial.readBytes(buffer, HELLO_LENGTH);
+  if (buffer[1] != 'T' || buffer[2] != 'N') return;
+
+  long baud_rate = 0;
+  for (int i = 4; i < 11; i++) {
+    baud_rate = baud_rate * 10 + buffer[i] - '0';
+  }
+  Serial.write("ETN");
+  Serial.write('0' + PROTOCOL_VERSION);
+  Serial.flush();
+  Serial.end();
+  Serial.begin(baud_rate);
+  compact = true;
+}
+
+void read_legacy_frame() {
+  Serial.readBytes(buffer, LEGACY_FRAME_LENGTH);
+  for (int pin = FIRST_PIN; pin < LEGACY_FRAME_LENGTH; pin++) {
+    if (buffer[pin] == 0) digitalWrite(pin, LOW);
+    if (buffer[pin] == 1) digitalWrite(pin, HIGH);
+  }
+}
+
+void write_pins(unsigned int states, unsigned int changes) {
+  for (int pin = FIRST_PIN; pin <= LAST_PIN; pin++) {
+    if (changes >> pin & 1) digitalWrite(pin, states >> pin & 1 ? HIGH : LOW);
+  }
+}
+
+void schedule(unsigned long timestamp, unsigned int states, unsigned int changes) {
+  if (queue_size == QUEUE_LENGTH) {
+    // Out of room, the oldest frame goes out early rather than not at all
+    write_pins(queue[queue_head].states, queue[queue_head].changes);
+    queue_head = (queue_head + 1) % QUEUE_LENGTH;
+    queue_size--;
+  }
+  Scheduled &frame = queue[(queue_head + queue_size) % QUEUE_LENGTH];
+  frame.timestamp = timestamp;
+  frame.states = states;
+  frame.changes = changes;
+  queue_size++;
+}
+
+void sync(unsigned long timestamp, bool running) {
+  unsigned long now = micros();
+  long error = (long) (timestamp - (now + clock_offset));
+  if (!clock_running || abs(error) > SYNC_JUMP) {
+    clock_offset = timestamp - now;
+  } else {
+    clock_offset += error / SYNC_SMOOTHING;
+  }
+  clock_running = running;
+  if (!running) frozen_clock = timestamp;
+}
+
+// Bytes of the packet starting with `first`, a chunk's count decides its length once it is there
+int packet_length(int first) {
+  if ((first & 0xFE) == FRAME_START) return FRAME_LENGTH + (first & FRAME_TIMESTAMP ? TIMESTAMP_LENGTH : 0);
+  if (first == SYNC_START) return SYNC_LENGTH;
+  if (first == CLEAR_START) return CLEAR_LENGTH;
+  if (first == CHUNK_START) return 2;
+  return -1;
+}
+
+void handle_packet(int length) {
+  // A packet with a bad checksum is dropped
+  if (crc8(buffer, length - 1) != buffer[length - 1]) return;
+
+  switch (buffer[0]) {
+    case FRAME_START:
+      write_pins(read_u16(buffer + 1), read_u16(buffer + 3));
+      break;
+    case FRAME_START | FRAME_TIMESTAMP:
+      schedule(read_u32(buffer + 5), read_u16(buffer + 1), read_u16(buffer + 3));
+      break;
+    case SYNC_START:
+      sync(read_u32(buffer + 1), buffer[5]);
+      break;
+    case CHUNK_START:
+      for (byte *frame = buffer + 2; frame < buffer + length - 1; frame += CHUNK_FRAME_LENGTH) {
+        schedule(read_u32(frame + 4), read_u16(frame), read_u16(frame + 2));
+      }
+      break;
+    case CLEAR_START:
+      queue_head = queue_size = 0;
+      break;
+  }
+}
+
+void fire_due_frames() {
+  unsigned long now = device_clock();
+  while (queue_size && (long) (now - queue[queue_head].timestamp) >= 0) {
+    write_pins(queue[queue_head].states, queue[queue_head].changes);
+    queue_head = (queue_head + 1) % QUEUE_LENGTH;
+    queue_size--;
+  }
 }
 
-byte byte_buffer[12];
 void loop() {
-  while (Serial.available() >= 12) {
-    Serial.readBytes(byte_buffer, 12);
-    for (int i = 0; i < 12; i++) {
-      if (byte_buffer[i] == 0) digitalWrite(i, LOW);
-      if (byte_buffer[i] == 1) digitalWrite(i, HIGH);
+  fire_due_frames();
+  while (Serial.available()) {
+    if (received == 0) {
+      int first = Serial.peek();
+      if (first == 'E') {
+        if (Serial.available() < HELLO_LENGTH) return;
+        handshake();
+        continue;
+      }
+      if (!compact) {
+        // Legacy frames only hold 0, 1 and 0xFF. Anything else is the rest of a hello
+        // or noise from before the port was up, skipping it gets back in step
+        if (first != 0 && first != 1 && first != 0xFF) {
+          Serial.read();
+          continue;
+        }
+        if (Serial.available() < LEGACY_FRAME_LENGTH) return;
+        read_legacy_frame();
+        continue;
+      }
+      expected = packet_length(first);
+      if (expected < 0) {
+        // Stray bytes up to the next start byte are skipped
+        Serial.read();
+        continue;
+      }
+    }
+
+    buffer[received++] = Serial.read();
+    if (received == 2 && buffer[0] == CHUNK_START) {
+      if (buffer[1] < 1 || buffer[1] > MAX_CHUNK_FRAMES) {
+        received = 0;
+        continue;
+      }
+      expected = 3 + buffer[1] * CHUNK_FRAME_LENGTH;
+    }
+    if (received == expected) {
+      handle_packet(received);
+      received = 0;
     }
   }
 }
-
@@ -0,0 +1,205 @@
+import os
+import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+from attr import attrib, attrs
+
+from definitions import cache_path
+from simfile_parsing.simfile_parser import AugmentedChart, parse_simfile
+
+SIMFILE_EXTENSIONS = ('.sm',)
+NOTE_OBJECTS = '124'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS songs (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    title TEXT,
+    subtitle TEXT,
+    artist TEXT,
+    bpm_min REAL,
+    bpm_max REAL,
+    length REAL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS charts (
+    path TEXT NOT NULL REFERENCES songs(path) ON DELETE CASCADE,
+    chart_index INTEGER NOT NULL,
+    step_artist TEXT,
+    diff_name TEXT,
+    diff_value INTEGER,
+    note_count INTEGER,
+    length REAL,
+    PRIMARY KEY (path, chart_index)
+);
+CREATE INDEX IF NOT EXISTS songs_title ON songs(title);
+'''
+
+
+@attrs(cmp=False)
+class ChartEntry(object):
+    chart_index: int = attrib()
+    step_artist: str = attrib()
+    diff_name: str = attrib()
+    diff_value: int = attrib()
+    note_count: int = attrib()
+    length: float = attrib()
+
+    @classmethod
+    def from_chart(cls, chart_index: int, chart: AugmentedChart):
+        return cls(chart_index,
+                   chart.step_artist,
+                   chart.diff_name,
+                   chart.diff_value,
+                   chart.note_field.count_of(NOTE_OBJECTS),
+                   float(chart.timed_note_field.times[-1]) if len(chart.note_field) else 0.)
+
+
+@attrs(cmp=False)
+class SongEntry(object):
+    path: str = attrib()
+    mtime: float = attrib()
+    size: int = attrib()
+    title: str = attrib(default='')
+    subtitle: str = attrib(default='')
+    artist: str = attrib(default='')
+    bpm_min: float = attrib(default=0.)
+    bpm_max: float = attrib(default=0.)
+    length: float = attrib(default=0.)
+    error: Optional[str] = attrib(default=None)
+    charts: List[ChartEntry] = attrib(factory=list)
+
+
+def find_simfiles(songs_dir: str) -> Iterator[Tuple[str, float, int]]:
+    """Yield path, mtime and size of every simfile under `songs_dir`"""
+    for root, _, files in os.walk(songs_dir):
+        for file_name in files:
+            if not file_name.lower().endswith(SIMFILE_EXTENSIONS):
+                continue
+            path = os.path.abspath(os.path.join(root, file_name))
+            stat = os.stat(path)
+            yield path, stat.st_mtime, stat.st_size
+
+
+def index_simfile(source: Tuple[str, float, int]) -> SongEntry:
+    """Parse a single simfile into a `SongEntry`, runs inside the worker processes"""
+    path, mtime, size = source
+    entry = SongEntry(path, mtime, size)
+    try:
+        simfile = parse_simfile(path)
+    except Exception as E:
+        entry.error = f'{type(E).__name__}: {E}'
+        return entry
+
+    entry.title = simfile.title
+    entry.subtitle = simfile.subtitle
+    entry.artist = simfile.artist
+    bpms = [float(segment.value) for segment in simfile.bpm_segments]
+    entry.bpm_min, entry.bpm_max = (min(bpms), max(bpms)) if bpms else (0., 0.)
+    entry.charts = [
+        ChartEntry.from_chart(chart_index, chart)
+        for chart_index, chart in enumerate(simfile.charts)
+    ]
+    entry.length = max((chart.length for chart in entry.charts), default=0.)
+    return entry
+
+
+class SongLibrary(object):
+    def __init__(self, database_path: Optional[str] = None, max_workers: Optional[int] = None):
+        self.database_path = database_path or cache_path('library.sqlite3')
+        self.max_workers = max_workers
+        self.connection = sqlite3.connect(self.database_path)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def scan(self, songs_dir: str, progress=None) -> Tuple[int, int]:
+        """Bring the index for `songs_dir` up to date.
+
+        Only simfiles whose mtime or size changed are parsed again, entries of deleted
+        simfiles are dropped. Returns the amount of (re)parsed and removed simfiles.
+        """
+        songs_dir = os.path.abspath(songs_dir)
+        known = {
+            path: (mtime, size)
+            for path, mtime, size in self.connection.execute(
+                "SELECT path, mtime, size FROM songs WHERE path LIKE ? ESCAPE '\\'",
+                (self._escape_like(os.path.join(songs_dir, '')) + '%',)
+            )
+        }
+
+        found = list(find_simfiles(songs_dir))
+        stale = [
+            source
+            for source in found
+            if known.get(source[0]) != source[1:]
+        ]
+        removed = known.keys() - {path for path, _, _ in found}
+
+        with self.connection:
+            self.connection.executemany('DELETE FROM songs WHERE path = ?', ((path,) for path in removed))
+
+        if stale:
+            with ProcessPoolExecutor(self.max_workers) as executor:
+                for done, entry in enumerate(executor.map(index_simfile, stale, chunksize=8), start=1):
+                    self.store(entry)
+                    progress and progress(done, len(stale))
+
+        return len(stale), len(removed)
+
+    def store(self, entry: SongEntry):
+        with self.connection:
+            self.connection.execute('DELETE FROM songs WHERE path = ?', (entry.path,))
+            self.connection.execute(
+                'INSERT INTO songs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (entry.path, entry.mtime, entry.size, entry.title, entry.subtitle, entry.artist,
+                 entry.bpm_min, entry.bpm_max, entry.length, entry.error)
+            )
+            self.connection.executemany(
+                'INSERT INTO charts VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (
+                    (entry.path, chart.chart_index, chart.step_artist, chart.diff_name,
+                     chart.diff_value, chart.note_count, chart.length)
+                    for chart in entry.charts
+                )
+            )
+
+    def songs(self, search: str = '') -> List[SongEntry]:
+        rows = self.connection.execute(
+            "SELECT * FROM songs WHERE error IS NULL AND (title LIKE ? ESCAPE '\\' OR artist LIKE ? ESCAPE '\\') "
+            "ORDER BY title COLLATE NOCASE",
+            ('%' + self._escape_like(search) + '%',) * 2
+        ).fetchall()
+        return [self._load_song(row) for row in rows]
+
+    def song(self, path: str) -> Optional[SongEntry]:
+        row = self.connection.execute('SELECT * FROM songs WHERE path = ?', (os.path.abspath(path),)).fetchone()
+        return row and self._load_song(row)
+
+    def _load_song(self, row) -> SongEntry:
+        entry = SongEntry(*row)
+        entry.charts = [
+            ChartEntry(*chart_row)
+            for chart_row in self.connection.execute(
+                'SELECT chart_index, step_artist, diff_name, diff_value, note_count, length '
+                'FROM charts WHERE path = ? ORDER BY chart_index',
+                (entry.path,)
+            )
+        ]
+        return entry
+
+    @staticmethod
+    def _escape_like(value: str) -> str:
+        return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+if __name__ == '__main__':
+    library = SongLibrary()
+    parsed, removed = library.scan(sys.argv[1], lambda done, total: print(f'\r{done}/{total}', end=''))
+    print(f'\nParsed {parsed} simfiles, removed {removed}')
+    library.close()
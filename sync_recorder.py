@@ -0,0 +1,67 @@
+from typing import Dict, Tuple
+
+import numpy as np
+
+# Lateness histogram edges in milliseconds
+HISTOGRAM_EDGES = (-np.inf, -5, -2, -1, -0.5, 0, 0.5, 1, 2, 5, 10, 20, np.inf)
+HISTOGRAM_WIDTH = 40
+
+
+class SyncRecorder(object):
+    """Scheduled and actual times of every frame written to the Arduino.
+
+    Both are on the audio clock, so lateness is how far the LED is off from the
+    music as heard. Arrays grow by doubling, recording never allocates per event.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.scheduled = np.zeros(capacity, dtype=np.float64)
+        self.actual = np.zeros(capacity, dtype=np.float64)
+        self.count = 0
+
+    def record(self, scheduled: float, actual: float):
+        if self.count == self.scheduled.size:
+            self.scheduled = np.concatenate((self.scheduled, np.zeros_like(self.scheduled)))
+            self.actual = np.concatenate((self.actual, np.zeros_like(self.actual)))
+        self.scheduled[self.count] = scheduled
+        self.actual[self.count] = actual
+        self.count += 1
+
+    def clear(self):
+        self.count = 0
+
+    @property
+    def lateness(self) -> np.ndarray:
+        """Seconds every write came after its scheduled time, negative when early"""
+        return self.actual[:self.count] - self.scheduled[:self.count]
+
+    def summary(self) -> Dict[str, float]:
+        lateness = self.lateness * 1000
+        if not lateness.size:
+            return {'count': 0}
+        p50, p99 = np.percentile(lateness, [50, 99])
+        return {
+            'count': lateness.size,
+            'p50': p50,
+            'p99': p99,
+            'max': lateness.max(),
+            'min': lateness.min()
+        }
+
+    def histogram(self) -> Tuple[np.ndarray, np.ndarray]:
+        return np.histogram(self.lateness * 1000, bins=HISTOGRAM_EDGES)
+
+    def report(self) -> str:
+        summary = self.summary()
+        if not summary['count']:
+            return 'No frames written'
+
+        lines = [
+            f'{summary["count"]} frames, lateness p50 {summary["p50"]:.3f} ms, '
+            f'p99 {summary["p99"]:.3f} ms, max {summary["max"]:.3f} ms, min {summary["min"]:.3f} ms'
+        ]
+        counts, edges = self.histogram()
+        scale = HISTOGRAM_WIDTH / max(counts.max(), 1)
+        for count, low, high in zip(counts, edges[:-1], edges[1:]):
+            lines.append(f'{low:>6} .. {high:<6} ms {count:>7} {"#" * int(np.ceil(count * scale))}')
+        return '\n'.join(lines)
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import struct
+from typing import Optional
+
+import numpy as np
+from numpy.lib.format import descr_to_dtype, dtype_to_descr
+from attr import attrib, attrs
+
+from definitions import cache_path
+from event_scheduler import EventScheduler
+from simfile_parsing.basic_types import Time
+from simfile_parsing.note_field import NoteField
+from simfile_parsing.simfile_parser import AugmentedChart
+from simfile_parsing.snaps import SnapColumns
+
+# Bump whenever the layout of the stored arrays or how they are computed changes
+TIMELINE_FORMAT = 3
+TIMELINE_MAGIC = b'ETNTL001'
+HEADER_PREFIX = struct.Struct('<8sI')
+ARRAY_ALIGNMENT = 64
+
+NOTE_FIELD_ARRAYS = ('numerators', 'denominators', 'objects', 'times')
+SNAP_ARRAYS = ('values', 'pin_masks', 'colors')
+
+
+@attrs(cmp=False, slots=True)
+class CompiledTimeline(object):
+    """Everything `ChartPlayer` needs before it can start a chart"""
+    notes: NoteField = attrib()
+    events: np.ndarray = attrib()
+
+
+def timeline_key(chart: AugmentedChart,
+                 scheduler: EventScheduler,
+                 sound_start_delta: Time = 0) -> Optional[str]:
+    """Cache key of `chart` compiled by `scheduler`, None for charts that don't come from a file"""
+    if chart.simfile_digest is None:
+        return None
+
+    lanes = chart.note_field.lanes
+    parts = (
+        TIMELINE_FORMAT,
+        chart.simfile_digest,
+        chart.chart_index,
+        str(scheduler.blink_duration),
+        str(scheduler.microblink_duration),
+        str(scheduler.frame_spacing),
+        sorted(scheduler.lane_pin_map(lanes).items()),
+        str(sound_start_delta)
+    )
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+
+def compile_timeline(chart: AugmentedChart,
+                     scheduler: EventScheduler,
+                     sound_start_delta: Time = 0,
+                     timeline_cache: Optional['TimelineCache'] = None) -> CompiledTimeline:
+    """Rows of `chart` that light something up and their events, from `timeline_cache` if it has them"""
+    key = timeline_cache and timeline_key(chart, scheduler, sound_start_delta)
+    timeline = key and timeline_cache.load(key)
+    if timeline:
+        return timeline
+
+    notes = chart.timed_note_field
+    notes = notes.select(notes.any_of('12345')).shifted(sound_start_delta)
+    timeline = CompiledTimeline(notes, scheduler.schedule_events(notes))
+    key and timeline_cache.store(key, timeline)
+    return timeline
+
+
+class TimelineCache(object):
+    """Compiled timelines, one memory-mappable file each.
+
+    A file starts with `TIMELINE_MAGIC`, the length of a JSON header and the header,
+    which holds dtype, shape and offset of every array. Arrays follow, aligned to
+    `ARRAY_ALIGNMENT`, and are loaded as read-only views of a single memory map.
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory or os.path.dirname(cache_path('timelines', ''))
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.timeline')
+
+    def load(self, key: str) -> Optional[CompiledTimeline]:
+        try:
+            mapped = np.memmap(self._path(key), dtype=np.uint8, mode='r')
+            magic, header_length = HEADER_PREFIX.unpack_from(mapped)
+            if magic != TIMELINE_MAGIC:
+                return None
+            header = json.loads(mapped[HEADER_PREFIX.size:HEADER_PREFIX.size + header_length].tobytes())
+            arrays = {
+                name: np.ndarray(tuple(shape), descr_to_dtype(_as_descr(descr)), buffer=mapped, offset=offset)
+                for name, (descr, shape, offset) in header.items()
+            }
+
+            notes = NoteField(*(arrays[f'notes_{name}'] for name in NOTE_FIELD_ARRAYS))
+            notes._snaps = SnapColumns(*(arrays[f'snaps_{name}'] for name in SNAP_ARRAYS))
+            return CompiledTimeline(notes, arrays['events'])
+        except (OSError, KeyError, ValueError, TypeError, struct.error):
+            return None
+
+    def store(self, key: str, timeline: CompiledTimeline):
+        arrays = {'events': timeline.events}
+        arrays.update((f'notes_{name}', getattr(timeline.notes, name)) for name in NOTE_FIELD_ARRAYS)
+        arrays.update((f'snaps_{name}', getattr(timeline.notes.snaps, name)) for name in SNAP_ARRAYS)
+        arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+
+        header = {}
+        offset = 0
+        for name, array in arrays.items():
+            header[name] = (dtype_to_descr(array.dtype), array.shape, offset)
+            offset = _aligned(offset + array.nbytes)
+        # Array offsets depend on the header length, so lay them out relative to it
+        header_bytes = json.dumps(header).encode('utf-8')
+        data_start = _aligned(HEADER_PREFIX.size + len(header_bytes) + 32)
+        header = {name: (descr, shape, data_start + offset) for name, (descr, shape, offset) in header.items()}
+        header_bytes = json.dumps(header).encode('utf-8')
+
+        path = self._path(key)
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        with open(temporary_path, mode='wb') as timeline_file:
+            timeline_file.write(HEADER_PREFIX.pack(TIMELINE_MAGIC, len(header_bytes)))
+            timeline_file.write(header_bytes)
+            for name, array in arrays.items():
+                timeline_file.seek(header[name][2])
+                timeline_file.write(array.tobytes())
+        os.replace(temporary_path, path)
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+
+
+def _as_descr(descr):
+    # JSON turns the (name, descr[, shape]) tuples of structured dtypes into lists
+    if isinstance(descr, str):
+        return descr
+    return [
+        (field[0], _as_descr(field[1]), *map(tuple, field[2:]))
+        for field in descr
+    ]